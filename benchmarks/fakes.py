@@ -0,0 +1,136 @@
+import io
+import json
+import time
+import random
+import hashlib
+import threading
+from botocore.exceptions import ClientError
+
+
+def synthetic_event_stream(answer_chars=1500, chunk_chars=20, citation_every_chars=200, refs_per_citation=2,
+                           n_documents=20, chunk_text_chars=800, seed=0):
+    """Build a retrieve_and_generate_stream event list shaped like a real one.
+
+    The answer is sent in `chunk_chars` output events, with one citation event (citing `refs_per_citation` chunks of
+    random documents) after every `citation_every_chars` characters of text.
+    """
+    rng = random.Random(seed)
+    words = ["bedrock", "knowledge", "base", "answer", "source", "document", "chunk", "policy", "grant", "award"]
+    text = ""
+    while len(text) < answer_chars:
+        text += rng.choice(words) + rng.choice([" ", " ", " ", ". ", ", "])
+    text = text[:answer_chars]
+
+    events = []
+    cited_until = 0
+    for start in range(0, len(text), chunk_chars):
+        end = min(start + chunk_chars, len(text))
+        events.append({"output": {"text": text[start:end]}})
+        if citation_every_chars and end - cited_until >= citation_every_chars:
+            references = []
+            for _ in range(refs_per_citation):
+                doc = rng.randrange(n_documents)
+                references.append({
+                    "content": {"text": f"chunk of document {doc}: " + "lorem ipsum " * (chunk_text_chars // 12)},
+                    "location": {"type": "S3", "s3Location": {"uri": f"s3://bench-bucket/docs/doc-{doc}.pdf"}},
+                    "metadata": {"x-amz-bedrock-kb-document-page-number": float(rng.randrange(1, 50))},
+                })
+            events.append({"citation": {"citation": {
+                "generatedResponsePart": {"textResponsePart": {"span": {"start": cited_until, "end": end - 1}, "text": text[cited_until:end]}},
+                "retrievedReferences": references,
+            }}})
+            cited_until = end
+    return events
+
+
+def record_event_stream(kb_response, path):
+    """Consume a live retrieve_and_generate_stream response, saving its events and their timing for replay.
+
+    :return: The response with its stream replaced by the recorded events, so the caller can still use it.
+    """
+    start = time.perf_counter()
+    events, offsets_ms = [], []
+    for event in kb_response["stream"]:
+        events.append(event)
+        offsets_ms.append((time.perf_counter() - start) * 1000)
+    with open(path, "w") as f:
+        json.dump({"events": events, "offsets_ms": offsets_ms}, f)
+    return {**kb_response, "stream": events}
+
+
+def load_recording(path):
+    with open(path, "r") as f:
+        recording = json.load(f)
+    return recording["events"], recording.get("offsets_ms")
+
+
+class FakeBedrockAgentRuntime:
+    """Stand-in for the bedrock-agent-runtime client that replays an event stream.
+
+    Events are delivered after `first_event_delay_ms`, then every `event_delay_ms` (or at the recorded offsets when
+    `offsets_ms` is given), from a generator, as botocore's EventStream does.
+    """
+
+    def __init__(self, events, first_event_delay_ms=300, event_delay_ms=15, offsets_ms=None):
+        self.events = events
+        self.first_event_delay_ms = first_event_delay_ms
+        self.event_delay_ms = event_delay_ms
+        self.offsets_ms = offsets_ms
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _replay(self):
+        start = time.perf_counter()
+        for index, event in enumerate(self.events):
+            if self.offsets_ms is not None:
+                due_ms = self.offsets_ms[index]
+            else:
+                due_ms = self.first_event_delay_ms + index * self.event_delay_ms
+            wait = due_ms / 1000 - (time.perf_counter() - start)
+            if wait > 0:
+                time.sleep(wait)
+            yield event
+
+    def retrieve_and_generate_stream(self, **kwargs):
+        with self._lock:
+            self.calls += 1
+        return {"sessionId": kwargs.get("sessionId") or f"bench-session-{self.calls}", "stream": self._replay()}
+
+
+class _Body(io.BytesIO):
+    def iter_chunks(self, chunk_size=1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class FakeS3Client:
+    """In-memory S3 stand-in supporting the get_object calls (including IfNoneMatch) used by DocumentCache."""
+
+    def __init__(self, latency_ms=50, bandwidth_mb_s=100):
+        self.latency_ms = latency_ms
+        self.bandwidth_mb_s = bandwidth_mb_s
+        self.objects = {}
+        self.get_calls = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        with self._lock:
+            self.get_calls += 1
+        time.sleep(self.latency_ms / 1000)
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "Not found"}}, "GetObject")
+        data = self.objects[(Bucket, Key)]
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        if IfNoneMatch == etag:
+            raise ClientError({"Error": {"Code": "304", "Message": "Not Modified"}}, "GetObject")
+        time.sleep(len(data) / (self.bandwidth_mb_s * 1024 * 1024))
+        with self._lock:
+            self.bytes_sent += len(data)
+        return {"Body": _Body(data), "ETag": etag, "ContentLength": len(data)}
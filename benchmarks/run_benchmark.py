@@ -0,0 +1,195 @@
+"""Offline benchmark of the chat pipeline against local Bedrock / S3 stand-ins.
+
+Run from the project root, e.g.:
+
+    python -m benchmarks.run_benchmark --users 8 --requests-per-user 5
+    python -m benchmarks.run_benchmark --recording recorded_stream.json --json results.json
+"""
+import time
+import json
+import logging
+import argparse
+import resource
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from client_packages.aws_clients import register_client
+from client_packages.bedrock_client import KnowledgeBaseChat
+from client_packages.request_engine import BedrockRequestEngine
+from client_packages.telemetry import latency_stats
+from client_packages import utils
+from benchmarks.fakes import FakeBedrockAgentRuntime, FakeS3Client, synthetic_event_stream, load_recording
+
+
+def percentiles(samples_ms):
+    if not samples_ms:
+        return {}
+    samples_ms = sorted(samples_ms)
+
+    def pick(fraction):
+        return round(samples_ms[min(len(samples_ms) - 1, int(fraction * len(samples_ms)))], 2)
+
+    return {"count": len(samples_ms), "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "max_ms": round(samples_ms[-1], 2)}
+
+
+class Measure:
+    """Wall time, CPU time and (optionally) peak traced Python memory of a block."""
+
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.result = {}
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.result["wall_s"] = round(time.perf_counter() - self._wall, 3)
+        self.result["cpu_s"] = round(time.process_time() - self._cpu, 3)
+        if self.trace_memory:
+            self.result["peak_traced_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 2)
+            tracemalloc.stop()
+        return False
+
+
+def run_chat(kb_chat, users, requests_per_user, streaming, engine=None, trace_memory=False):
+    """Simulated users each asking `requests_per_user` questions back to back."""
+    ttft_ms, total_ms = [], []
+
+    def one_user(user):
+        session_id = None
+        for request in range(requests_per_user):
+            start = time.perf_counter()
+            question = f"question {request} from user {user}"
+            if streaming:
+                result = {}
+                if engine is not None:
+                    text_stream = engine.chat_with_model_stream(f"user-{user}", session_id, question, "prompt", "prompt", result=result)
+                else:
+                    text_stream = kb_chat.chat_with_model_stream(session_id, question, "prompt", "prompt", result=result)
+                first = None
+                for _ in text_stream:
+                    if first is None:
+                        first = time.perf_counter()
+                ttft_ms.append(((first or time.perf_counter()) - start) * 1000)
+                session_id = result["session_id"]
+            elif engine is not None:
+                session_id, _, _ = engine.chat_with_model(f"user-{user}", session_id, question, "prompt", "prompt")
+            else:
+                session_id, _, _ = kb_chat.chat_with_model(session_id, question, "prompt", "prompt")
+            total_ms.append((time.perf_counter() - start) * 1000)
+
+    with Measure(trace_memory) as measure, ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(one_user, range(users)))
+
+    report = {"end_to_end": percentiles(total_ms), **measure.result}
+    if streaming:
+        report["time_to_first_token"] = percentiles(ttft_ms)
+    report["requests_per_s"] = round(len(total_ms) / measure.result["wall_s"], 2)
+    return report
+
+
+def run_render(kb_chat, events, iterations, trace_memory=False):
+    """CPU cost of citation splicing and link rewriting for one answer, without any I/O."""
+    text = "".join(e["output"]["text"] for e in events if "output" in e)
+    citations = kb_chat.citations_to_text_pieces([e["citation"]["citation"] for e in events if "citation" in e])
+    add_references_ms, render_ms, legacy_links_ms = [], [], []
+    with Measure(trace_memory) as measure:
+        for _ in range(iterations):
+            start = time.perf_counter()
+            output_text, _ = kb_chat.add_references(text, citations)
+            add_references_ms.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            kb_chat.add_references(text, citations, utils.render_answer_segment)
+            render_ms.append((time.perf_counter() - start) * 1000)
+
+            start = time.perf_counter()
+            utils.replace_bracketed_numbers_with_links(output_text, "#")
+            legacy_links_ms.append((time.perf_counter() - start) * 1000)
+    return {
+        "add_references": percentiles(add_references_ms),
+        "add_references_with_render": percentiles(render_ms),
+        "replace_bracketed_numbers_with_links": percentiles(legacy_links_ms),
+        **measure.result,
+    }
+
+
+def run_s3(s3, users, opens_per_user, n_documents, document_kb, trace_memory=False):
+    """Users opening cited documents through download_s3_file, with a fresh local cache."""
+    for doc in range(n_documents):
+        s3.put_object(Bucket="bench-bucket", Key=f"docs/doc-{doc}.pdf", Body=bytes(document_kb * 1024))
+    target_folder = tempfile.mkdtemp(prefix="chatbot-bench-")
+    open_ms = []
+
+    def one_user(user):
+        for index in range(opens_per_user):
+            start = time.perf_counter()
+            utils.download_s3_file(f"s3://bench-bucket/docs/doc-{(user + index) % n_documents}.pdf", target_folder)
+            open_ms.append((time.perf_counter() - start) * 1000)
+
+    with Measure(trace_memory) as measure, ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(one_user, range(users)))
+    return {"open_document": percentiles(open_ms), "s3_get_calls": s3.get_calls, "s3_mb_sent": round(s3.bytes_sent / 1024 / 1024, 2), **measure.result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4, help="Concurrent simulated users")
+    parser.add_argument("--requests-per-user", type=int, default=3)
+    parser.add_argument("--recording", help="Replay a stream saved by benchmarks.fakes.record_event_stream")
+    parser.add_argument("--answer-chars", type=int, default=1500)
+    parser.add_argument("--chunk-chars", type=int, default=20, help="Characters per output event")
+    parser.add_argument("--citation-every-chars", type=int, default=200, help="Citation density")
+    parser.add_argument("--refs-per-citation", type=int, default=2)
+    parser.add_argument("--first-event-delay-ms", type=float, default=300)
+    parser.add_argument("--event-delay-ms", type=float, default=15)
+    parser.add_argument("--engine", action="store_true", help="Send chat requests through BedrockRequestEngine")
+    parser.add_argument("--render-iterations", type=int, default=200)
+    parser.add_argument("--s3-latency-ms", type=float, default=50)
+    parser.add_argument("--s3-documents", type=int, default=10)
+    parser.add_argument("--s3-document-kb", type=int, default=512)
+    parser.add_argument("--s3-opens-per-user", type=int, default=5)
+    parser.add_argument("--trace-memory", action="store_true", help="Report peak traced Python memory (slower)")
+    parser.add_argument("--json", help="Also write the report to this file")
+    args = parser.parse_args()
+
+    if args.recording:
+        events, offsets_ms = load_recording(args.recording)
+    else:
+        events, offsets_ms = synthetic_event_stream(
+            answer_chars=args.answer_chars,
+            chunk_chars=args.chunk_chars,
+            citation_every_chars=args.citation_every_chars,
+            refs_per_citation=args.refs_per_citation,
+        ), None
+
+    kb_chat = KnowledgeBaseChat(render_segment=utils.render_answer_segment)
+    kb_chat.answer_cache = None  # measure the full pipeline on every request
+    kb_chat.bedrock_agent_runtime_client = FakeBedrockAgentRuntime(
+        events, args.first_event_delay_ms, args.event_delay_ms, offsets_ms
+    )
+    s3 = FakeS3Client(latency_ms=args.s3_latency_ms)
+    register_client("s3", s3)
+    logging.getLogger("document_chatbot.telemetry").setLevel(logging.WARNING)
+    engine = BedrockRequestEngine(kb_chat, **kb_chat.config.get("request_engine", {})) if args.engine else None
+
+    report = {
+        "chat_with_model": run_chat(kb_chat, args.users, args.requests_per_user, False, engine, args.trace_memory),
+        "chat_with_model_stream": run_chat(kb_chat, args.users, args.requests_per_user, True, engine, args.trace_memory),
+        "render": run_render(kb_chat, events, args.render_iterations, args.trace_memory),
+        "download_s3_file": run_s3(s3, args.users, args.s3_opens_per_user, args.s3_documents, args.s3_document_kb, args.trace_memory),
+        "telemetry": latency_stats.summary(),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+import json
+import math
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from client_packages.aws_clients import get_client
+
+
+def normalize_query(text):
+    """Lower-case, collapse whitespace and drop trailing punctuation so trivially different questions share a key."""
+    return " ".join(text.lower().split()).rstrip("?!. ")
+
+
+def sha256_hex(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def make_scope(kb_id, generation_prompt, orchestration_prompt, model_config):
+    """Hash everything besides the question that changes the answer: the knowledge base, both prompt templates and the
+    model / retrieval settings. Only entries with the same scope are ever compared."""
+    payload = {
+        "kb_id": kb_id,
+        "generation_prompt": sha256_hex(generation_prompt or ""),
+        "orchestration_prompt": sha256_hex(orchestration_prompt or ""),
+        "model_config": model_config,
+    }
+    return sha256_hex(json.dumps(payload, sort_keys=True, default=str))
+
+
+def make_cache_key(query, scope):
+    return sha256_hex(f"{scope}\n{normalize_query(query)}")
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class InMemoryBackend:
+    """Process-local LRU store. Entries are dicts with scope, query, embedding, value and created_at."""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def scope_entries(self, scope):
+        with self._lock:
+            return [(key, entry) for key, entry in self._entries.items() if entry["scope"] == scope]
+
+
+class SQLiteBackend:
+    """On-disk LRU store, so cached answers survive restarts and are shared by every worker on the host."""
+
+    def __init__(self, path, max_entries=1000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, scope TEXT, query TEXT, embedding TEXT, value TEXT, created_at REAL, last_access REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_scope ON answers (scope)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS answers_last_access ON answers (last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def _to_entry(row):
+        scope, query, embedding, value, created_at = row
+        return {
+            "scope": scope,
+            "query": query,
+            "embedding": json.loads(embedding) if embedding else None,
+            "value": json.loads(value),
+            "created_at": created_at,
+        }
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT scope, query, embedding, value, created_at FROM answers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE answers SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return self._to_entry(row)
+
+    def set(self, key, entry):
+        embedding = json.dumps(entry["embedding"]) if entry.get("embedding") else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, entry["scope"], entry["query"], embedding, json.dumps(entry["value"]), entry["created_at"], time.time()),
+            )
+            self._conn.execute(
+                "DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def scope_entries(self, scope):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, scope, query, embedding, value, created_at FROM answers WHERE scope = ? AND embedding IS NOT NULL",
+                (scope,),
+            ).fetchall()
+        return [(row[0], self._to_entry(row[1:])) for row in rows]
+
+
+class BedrockEmbedder:
+    """Embeds query text with a Bedrock embedding model (Titan text embeddings by default)."""
+
+    def __init__(self, model_id, region_name=None, client_config=None):
+        self.model_id = model_id
+        self.client = get_client("bedrock-runtime", region_name, client_config)
+
+    def __call__(self, text):
+        response = self.client.invoke_model(modelId=self.model_id, body=json.dumps({"inputText": text}))
+        return json.loads(response["body"].read())["embedding"]
+
+
+class AnswerCache:
+    """Exact-match answer cache with an optional embedding-similarity tier.
+
+    Values are whatever the caller stores (KnowledgeBaseChat stores the referenced text and citations); entries older
+    than `ttl_seconds` are treated as misses and dropped. The embeddings of the last `max_memo_embeddings` queries are
+    kept, so storing the answer to a question that just missed does not embed it a second time.
+    """
+
+    def __init__(self, backend, ttl_seconds=86400, embedder=None, similarity_threshold=0.95, max_memo_embeddings=256):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.embedder = embedder
+        self.similarity_threshold = similarity_threshold
+        self.max_memo_embeddings = max_memo_embeddings
+        self._embeddings = OrderedDict()
+        self._embeddings_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "stores": 0, "embeddings": 0}
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def _embed(self, normalized_query):
+        with self._embeddings_lock:
+            embedding = self._embeddings.get(normalized_query)
+            if embedding is not None:
+                self._embeddings.move_to_end(normalized_query)
+                return embedding
+        embedding = self.embedder(normalized_query)
+        self._count("embeddings")
+        with self._embeddings_lock:
+            self._embeddings[normalized_query] = embedding
+            while len(self._embeddings) > self.max_memo_embeddings:
+                self._embeddings.popitem(last=False)
+        return embedding
+
+    def _is_fresh(self, entry):
+        return self.ttl_seconds is None or time.time() - entry["created_at"] < self.ttl_seconds
+
+    def lookup(self, query, scope):
+        key = make_cache_key(query, scope)
+        entry = self.backend.get(key)
+        if entry is not None:
+            if self._is_fresh(entry):
+                self._count("hits")
+                return entry["value"]
+            self.backend.delete(key)
+
+        if self.embedder is not None:
+            embedding = self._embed(normalize_query(query))
+            best_key, best_entry, best_score = None, None, self.similarity_threshold
+            for candidate_key, candidate in self.backend.scope_entries(scope):
+                if not candidate.get("embedding") or not self._is_fresh(candidate):
+                    continue
+                score = cosine_similarity(embedding, candidate["embedding"])
+                if score >= best_score:
+                    best_key, best_entry, best_score = candidate_key, candidate, score
+            if best_entry is not None:
+                self.backend.get(best_key)  # refresh its LRU position
+                self._count("semantic_hits")
+                return best_entry["value"]
+
+        self._count("misses")
+        return None
+
+    def store(self, query, scope, value):
+        normalized_query = normalize_query(query)
+        entry = {
+            "scope": scope,
+            "query": normalized_query,
+            "embedding": self._embed(normalized_query) if self.embedder is not None else None,
+            "value": value,
+            "created_at": time.time(),
+        }
+        self.backend.set(make_cache_key(query, scope), entry)
+        self._count("stores")
+
+
+def build_answer_cache(cache_config, base_dir, region_name=None, client_config=None):
+    """Build an AnswerCache from the `answer_cache` section of config.yaml, or return None when it is disabled."""
+    if not cache_config or not cache_config.get("enabled"):
+        return None
+
+    max_entries = cache_config.get("max_entries", 1000)
+    if cache_config.get("backend", "memory") == "sqlite":
+        sqlite_path = base_dir / cache_config.get("sqlite_path", "data/answer_cache.sqlite3")
+        sqlite_path.parent.mkdir(parents=True, exist_ok=True)
+        backend = SQLiteBackend(sqlite_path, max_entries=max_entries)
+    else:
+        backend = InMemoryBackend(max_entries=max_entries)
+
+    embedder = None
+    semantic_config = cache_config.get("semantic", {})
+    if semantic_config.get("enabled"):
+        embedder = BedrockEmbedder(semantic_config["embedding_model_id"], region_name, client_config)
+
+    return AnswerCache(
+        backend,
+        ttl_seconds=cache_config.get("ttl_seconds", 86400),
+        embedder=embedder,
+        similarity_threshold=semantic_config.get("similarity_threshold", 0.95),
+    )
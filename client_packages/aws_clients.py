@@ -0,0 +1,75 @@
+import threading
+import boto3
+from botocore.config import Config
+
+# boto3 clients are thread-safe once built, but sessions are not, so building is serialised behind one lock and the
+# results are shared by every Streamlit session in the process.
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+# Calls to these services run on BedrockRequestEngine, which owns retries and the adaptive concurrency limit, so
+# botocore makes a single attempt instead of multiplying the engine's retries with its own
+ENGINE_RETRIED_SERVICES = {"bedrock-agent-runtime", "bedrock-runtime"}
+
+
+def build_botocore_config(client_config=None, engine_retried=False):
+    """Translate the `aws_client_configuration` section of config.yaml into a botocore Config.
+
+    With `engine_retried`, botocore retries are turned off and `retry_mode` / `max_attempts` are ignored.
+    """
+    client_config = client_config or {}
+    if engine_retried:
+        retries = {"mode": "standard", "total_max_attempts": 1}
+    else:
+        retries = {
+            "mode": client_config.get("retry_mode", "adaptive"),
+            "max_attempts": client_config.get("max_attempts", 5),
+        }
+    return Config(
+        max_pool_connections=client_config.get("max_pool_connections", 50),
+        connect_timeout=client_config.get("connect_timeout", 5),
+        read_timeout=client_config.get("read_timeout", 120),
+        tcp_keepalive=client_config.get("tcp_keepalive", True),
+        retries=retries,
+    )
+
+
+def get_session(region_name=None):
+    with _lock:
+        if region_name not in _sessions:
+            _sessions[region_name] = boto3.Session(region_name=region_name)
+        return _sessions[region_name]
+
+
+def get_client(service_name, region_name=None, client_config=None):
+    """Return the process-wide client for `service_name` in `region_name`, creating it on first use.
+
+    :param service_name: boto3 service name, e.g. "s3" or "bedrock-agent-runtime".
+    :param region_name: AWS region; None falls back to the default region resolution of boto3.
+    :param client_config: Optional `aws_client_configuration` dict, only used when the client is first created.
+    :return: A shared boto3 client.
+    """
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    session = get_session(region_name)
+    with _lock:
+        if key not in _clients:
+            config = build_botocore_config(client_config, engine_retried=service_name in ENGINE_RETRIED_SERVICES)
+            _clients[key] = session.client(service_name, region_name=region_name, config=config)
+        return _clients[key]
+
+
+def register_client(service_name, client, region_name=None):
+    """Make `client` the shared client for `service_name`, e.g. to plug in a local stand-in for benchmarks."""
+    with _lock:
+        _clients[(service_name, region_name)] = client
+
+
+def clear_clients():
+    """Drop every cached session and client, e.g. after rotating credentials."""
+    with _lock:
+        _clients.clear()
+        _sessions.clear()
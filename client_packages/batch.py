@@ -0,0 +1,201 @@
+"""Headless batch runner: ask every question of a JSONL/CSV file against the knowledge base.
+
+Run from the project root, e.g.:
+
+    python -m client_packages.batch questions.jsonl results.jsonl --concurrency 4 --rate 2
+    python -m client_packages.batch questions.csv results.parquet --generation-prompt-file new_prompt.txt
+
+Input rows need a "question" field and may have an "id" (the row number is used otherwise). Results are appended to
+the output as they complete, so an interrupted run picks up where it left off when started again with the same
+output; questions that failed, or whose answer was cut off ("partial"), are retried. A .parquet output is written from the JSONL once every question is done.
+"""
+import csv
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from client_packages.bedrock_client import KnowledgeBaseChat
+from client_packages.request_engine import RESUME_NOTICE, BedrockRequestEngine
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` acquisitions per second on average, with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def read_questions(path):
+    """Yield {"id", "question"} rows from a .jsonl or .csv file."""
+    path = Path(path)
+    with open(path, "r", newline="") as f:
+        rows = csv.DictReader(f) if path.suffix.lower() == ".csv" else (json.loads(line) for line in f if line.strip())
+        for row_number, row in enumerate(rows, start=1):
+            yield {"id": str(row.get("id") or row_number), "question": row["question"]}
+
+
+def completed_ids(jsonl_path):
+    """Ids already answered successfully in an earlier (possibly interrupted) run."""
+    done = set()
+    if not Path(jsonl_path).exists():
+        return done
+    with open(jsonl_path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by the interruption
+            if record.get("status") == "ok":
+                done.add(record["id"])
+    return done
+
+
+class BatchRunner:
+    def __init__(self, kb_chat, concurrency=4, rate=None, generation_prompt=None, orchestration_prompt=None,
+                 retrieval_profile=None):
+        self.engine = BedrockRequestEngine(kb_chat, max_concurrency=concurrency, **{
+            k: v for k, v in kb_chat.config.get("request_engine", {}).items() if k != "max_concurrency"
+        })
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate) if rate else None
+        self.generation_prompt = generation_prompt or kb_chat.settings.bedrock.generation_prompt
+        self.orchestration_prompt = orchestration_prompt or kb_chat.settings.bedrock.orchestration_prompt
+        self.retrieval_profile = retrieval_profile
+        self._write_lock = threading.Lock()
+
+    def ask(self, row):
+        """Answer one question on a fresh Bedrock session and return its result record."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        record = {"id": row["id"], "question": row["question"]}
+        result = {}
+        start = time.perf_counter()
+        first_text = None
+        plain_parts = []
+        try:
+            text_stream = self.engine.chat_with_model_stream(
+                "batch", None, row["question"], self.generation_prompt, self.orchestration_prompt, result=result,
+                retrieval_profile=self.retrieval_profile, stateless=True,
+            )
+            for delta in text_stream:
+                if first_text is None:
+                    first_text = time.perf_counter()
+                if delta == RESUME_NOTICE:
+                    plain_parts = []  # the interrupted answer is asked again from the start
+                    continue
+                plain_parts.append(delta)
+        except Exception as e:
+            record.update(status="error", error=f"{type(e).__name__}: {e}", latency_ms=round((time.perf_counter() - start) * 1000, 1))
+            return record
+
+        if result.get("cache_hit"):
+            # A cached answer streams no deltas; all of it is available at once
+            answer = result["plain_text"]
+            first_text = time.perf_counter()
+        else:
+            answer = "".join(plain_parts)
+        record.update(
+            status="partial" if result.get("partial") else "ok",
+            cache_hit=bool(result.get("cache_hit")),
+            answer=answer,
+            answer_with_references=result["text"],
+            citations=result["references"],
+            session_id=result["session_id"],
+            retrieval_profile=result.get("retrieval_profile"),
+            stream_resumes=result.get("resumes", 0),
+            error=result.get("error"),
+            latency_ms=round((time.perf_counter() - start) * 1000, 1),
+            time_to_first_text_ms=round((first_text - start) * 1000, 1) if first_text else None,
+            # retrieve_and_generate_stream does not report token usage, so output size is recorded instead
+            output_chars=len(answer),
+            n_citations=len(result["references"]),
+        )
+        return record
+
+    def run(self, questions, jsonl_path):
+        """Answer every question not already in `jsonl_path`, appending results as they complete."""
+        done = completed_ids(jsonl_path)
+        pending = [row for row in questions if row["id"] not in done]
+        print(f"{len(done)} questions already answered, {len(pending)} to go")
+
+        with open(jsonl_path, "a") as out, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            futures = [pool.submit(self.ask, row) for row in pending]
+            for index, future in enumerate(as_completed(futures), start=1):
+                record = future.result()
+                with self._write_lock:
+                    out.write(json.dumps(record) + "\n")
+                    out.flush()
+                print(f"[{index}/{len(pending)}] {record['id']}: {record['status']} ({record['latency_ms']} ms)")
+
+
+def write_parquet(jsonl_path, parquet_path):
+    """Convert the JSONL results (latest record per id) to Parquet."""
+    import pandas as pd
+
+    records = {}
+    with open(jsonl_path, "r") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                records[record["id"]] = record
+    df = pd.DataFrame(list(records.values()))
+    if "citations" in df:
+        df["citations"] = df["citations"].map(json.dumps)
+    df.to_parquet(parquet_path, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("questions", help="Input .jsonl or .csv with a 'question' column")
+    parser.add_argument("output", help="Output .jsonl or .parquet")
+    parser.add_argument("--concurrency", type=int, default=4, help="Questions in flight at once")
+    parser.add_argument("--rate", type=float, help="Maximum questions started per second")
+    parser.add_argument("--generation-prompt-file", help="Use this generation prompt instead of the configured one")
+    parser.add_argument("--orchestration-prompt-file", help="Use this orchestration prompt instead of the configured one")
+    parser.add_argument("--retrieval-profile", help="Retrieval profile name or 'auto' (default: the configured default)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the answer cache")
+    args = parser.parse_args()
+
+    kb_chat = KnowledgeBaseChat()
+    if args.no_cache:
+        kb_chat.answer_cache = None
+    runner = BatchRunner(
+        kb_chat,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        generation_prompt=Path(args.generation_prompt_file).read_text() if args.generation_prompt_file else None,
+        orchestration_prompt=Path(args.orchestration_prompt_file).read_text() if args.orchestration_prompt_file else None,
+        retrieval_profile=args.retrieval_profile,
+    )
+
+    output = Path(args.output)
+    jsonl_path = output.with_suffix(".partial.jsonl") if output.suffix.lower() == ".parquet" else output
+    runner.run(read_questions(args.questions), jsonl_path)
+    if kb_chat.answer_cache is not None:
+        stats = kb_chat.answer_cache.stats()
+        print("Answer cache: " + ", ".join(f"{count} {name.replace('_', ' ')}" for name, count in stats.items()))
+    if output.suffix.lower() == ".parquet":
+        write_parquet(jsonl_path, output)
+        print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
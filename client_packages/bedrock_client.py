@@ -1,70 +1,192 @@
-import os
-import yaml
-import boto3
-from yaml.loader import SafeLoader
+import threading
 from datetime import datetime, timezone
+from client_packages.aws_clients import get_client, get_session
+from client_packages.answer_cache import build_answer_cache, make_scope
+from client_packages.retrieval_profiles import resolve_retrieval_profile
+from client_packages.settings import CONFIG_PATH, get_settings
+from client_packages.stream_guard import guard_events
+from client_packages.telemetry import RequestTrace, configure_telemetry
 
 
 class KnowledgeBaseChat:
-    def __init__(self):
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        parent_dir = os.path.dirname(script_dir)  # Go up one level
-        config_path = os.path.join(parent_dir, "config", "config.yaml")
-        with open(config_path) as file:
-            self.config = yaml.load(file, Loader=SafeLoader)
-        self.aws_region = self.config["bedrock_configuration"].get("aws_region", None)
-        self.account_id = self.config["bedrock_configuration"].get("account_id", None)
-        self.session = boto3.Session(region_name=self.aws_region)
-        self.bedrock_agent_runtime_client = self.session.client("bedrock-agent-runtime", region_name=self.aws_region)
+    def __init__(self, render_segment=None):
+        self.render_segment = render_segment
+        self._settings = None
+        self._template = None
+        self._compile_lock = threading.Lock()
+        settings, _ = self.snapshot()  # compiles the request template
+        client_config = settings.get("aws_client_configuration", {})
+        self.session = get_session(self.aws_region)
+        self.bedrock_agent_runtime_client = get_client("bedrock-agent-runtime", self.aws_region, client_config)
+        self.answer_cache = build_answer_cache(settings.get("answer_cache"), CONFIG_PATH.parent.parent, self.aws_region, client_config)
+
+    def snapshot(self):
+        """Return (settings, template) of the current config, recompiling the template if config.yaml was reloaded.
+
+        The pair always belongs to the same config version. A request takes one snapshot and uses it throughout, since
+        reading `settings` again later may see a newer version than the template it started with.
+        """
+        with self._compile_lock:
+            settings = get_settings()
+            if settings is not self._settings:
+                self._compile(settings)
+            return self._settings, self._template
+
+    @property
+    def settings(self):
+        """Current Settings; see snapshot() for use within a request."""
+        return self.snapshot()[0]
+
+    @property
+    def config(self):
+        """The raw config.yaml dict, for the sections that have no typed settings."""
+        return self.settings.raw
+
+    def _compile(self, settings):
+        """Precompute everything in a request that only depends on the config; called with _compile_lock held.
+
+        The template is replaced as a whole, and requests read it through snapshot(), so a request being built during a
+        reload never mixes two versions. Its dicts are shared by every request built until the next reload, so they must
+        not be modified.
+        """
+        bedrock = settings.bedrock
+        configure_telemetry(settings.get("telemetry"))
+        if self._settings is not None and bedrock.aws_region != self.aws_region:
+            self.bedrock_agent_runtime_client = get_client(
+                "bedrock-agent-runtime", bedrock.aws_region, settings.get("aws_client_configuration", {})
+            )
+        self.aws_region = bedrock.aws_region
+        self.account_id = bedrock.account_id
+        self.kb_id = bedrock.kb_id
+
+        generation_config = {
+            "inferenceConfig": {
+                "textInferenceConfig": {
+                    "maxTokens": bedrock.generation.max_tokens,
+                    "temperature": bedrock.generation.temperature,
+                    "topP": bedrock.generation.top_p,
+                }
+            },
+        }
+        if bedrock.enable_guardrails:
+            generation_config["guardrailConfiguration"] = {
+                "guardrailId": bedrock.guardrail_id, "guardrailVersion": bedrock.guardrail_version
+            }
+        # One retrieval variant for bedrock_configuration itself (key None) and one per retrieval profile
+        retrieval = {None: self._compile_retrieval(bedrock, bedrock)}
+        for name, profile in settings.retrieval_profiles.items():
+            retrieval[name] = self._compile_retrieval(bedrock, profile)
+        self._template = {"generation": generation_config, "retrieval": retrieval}
+        self._settings = settings
+
+    def _compile_retrieval(self, bedrock, retrieval):
+        """Request parts that depend on the retrieval depth; `retrieval` is the BedrockSettings or a RetrievalProfile."""
+        vector_search_config = {
+            "overrideSearchType": retrieval.search_type,
+            "numberOfResults": retrieval.n_source_chunks,
+            "rerankingConfiguration": {
+                "bedrockRerankingConfiguration": {
+                    "modelConfiguration": {
+                        "modelArn": bedrock.rerank_model_arn,
+                    },
+                    "numberOfRerankedResults": retrieval.n_re_ranked_docs,
+                },
+                "type": "BEDROCK_RERANKING_MODEL",
+            },
+        }
+        orchestration_config = {
+            "inferenceConfig": {
+                "textInferenceConfig": {
+                    "maxTokens": bedrock.orchestration.max_tokens,
+                    "temperature": bedrock.orchestration.temperature,
+                    "topP": bedrock.orchestration.top_p,
+                }
+            },
+        }
+        # Without a query split type Bedrock runs the question as a single query
+        if retrieval.query_split_type is not None:
+            orchestration_config["queryTransformationConfiguration"] = {"type": retrieval.query_split_type}
+        knowledge_base_config = {
+            "knowledgeBaseId": bedrock.kb_id,
+            "modelArn": bedrock.generation_model_arn,
+            "retrievalConfiguration": {"vectorSearchConfiguration": vector_search_config},
+        }
+        cache_model_scope = {
+            "inference_model_id": bedrock.inference_model_id,
+            "rerank_model_id": bedrock.rerank_model_id,
+            "search_type": retrieval.search_type,
+            "n_source_chunks": retrieval.n_source_chunks,
+            "n_re_ranked_docs": retrieval.n_re_ranked_docs,
+            "bedrock_query_split_type": retrieval.query_split_type,
+            "guardrails": [bedrock.enable_guardrails, bedrock.guardrail_id, bedrock.guardrail_version],
+            "generation": vars(bedrock.generation),
+            "orchestration": vars(bedrock.orchestration),
+            "rendered": self.render_segment is not None,
+        }
+        return {
+            "vector_search": vector_search_config,
+            "orchestration": orchestration_config,
+            "knowledge_base": knowledge_base_config,
+            "cache_model_scope": cache_model_scope,
+        }
 
     @staticmethod
-    def add_references(input_text, citations):
+    def add_references(input_text, citations, render_segment=None):
+        """Splice reference links into the answer text in a single left-to-right pass.
+
+        Identical retrieved chunks (same source and text) are listed once and every citation of them links to the same
+        reference id. When given, `render_segment` is applied to each stretch of model text between reference links,
+        so the links themselves are never re-processed.
+        """
         citations = sorted(citations, key=lambda x: x["end"])
-        output_text = input_text
-        offset = 0
-        reference_counter = 1
+        parts = []
+        position = 0
         references = []
+        reference_ids = {}
 
         for pos in citations:
-            end = pos["end"]
-            count = len(pos["reference"])
-            actual_end = end + offset
-            reference_string = "".join([f'<a href="#ref-{reference_counter + i}" target="_self">[{reference_counter + i}]</a>' for i in range(count)])
-            output_text = output_text[:actual_end] + reference_string + output_text[actual_end:]
-            for index, value in enumerate(pos["reference"]):
-                references.append(
-                    {
-                        "id": reference_counter + index,
-                        "text": value["content"]["text"],
-                        "source": value["location"]["s3Location"]["uri"],
-                        "metadata": value["metadata"],
-                    }
-                )
-            offset += len(reference_string)
-            reference_counter += count
-
-        # output_text = output_text.replace("$", "\$")
-        return output_text, references
+            end = max(pos["end"], position)
+            segment = input_text[position:end]
+            parts.append(render_segment(segment) if render_segment else segment)
+            position = end
 
-    def stream_data(self, kb_response):
-        citations = []
-        session_id = None
-        op_steam = []
+            cited_ids = []
+            for value in pos["reference"]:
+                text = value["content"]["text"]
+                source = value["location"]["s3Location"]["uri"]
+                reference_id = reference_ids.get((source, text))
+                if reference_id is None:
+                    reference_id = reference_ids[(source, text)] = len(references) + 1
+                    references.append({"id": reference_id, "text": text, "source": source, "metadata": value["metadata"]})
+                if reference_id not in cited_ids:
+                    cited_ids.append(reference_id)
+            parts.extend(f'<a href="#ref-{reference_id}" target="_self">[{reference_id}]</a>' for reference_id in cited_ids)
 
-        if session_id is None and "sessionId" in kb_response:
-            session_id = kb_response["sessionId"]
+        segment = input_text[position:]
+        parts.append(render_segment(segment) if render_segment else segment)
+        return "".join(parts), references
 
-        if "stream" in kb_response:
-            op_steam = kb_response["stream"]
+    def stream_timeouts(self):
+        """First-event and inter-event timeouts for reading Bedrock streams, from the `stream` config section."""
+        stream_config = self.config.get("stream", {})
+        return {
+            "first_event_timeout": stream_config.get("first_event_timeout_seconds"),
+            "inter_event_timeout": stream_config.get("inter_event_timeout_seconds"),
+        }
+
+    def iter_stream_events(self, kb_response):
+        """Yield ("text", delta) and ("citation", citation) tuples in the order Bedrock sends them.
 
-        full_text = ""
-        for event in op_steam:
+        Raises StreamTimeout when Bedrock stays silent for longer than the configured stream timeouts.
+        """
+        for event in guard_events(kb_response.get("stream", []), **self.stream_timeouts()):
             if "output" in event:
-                text = event["output"]["text"]
-                full_text += text
+                yield "text", event["output"]["text"]
             if "citation" in event:
-                citations.append(event["citation"]["citation"])
+                yield "citation", event["citation"]["citation"]
 
+    @staticmethod
+    def citations_to_text_pieces(citations):
         text_pieces = []
         for citation in citations:
             text_piece = {
@@ -73,97 +195,246 @@ class KnowledgeBaseChat:
                 "reference": citation["retrievedReferences"],
             }
             text_pieces.append(text_piece)
+        return text_pieces
+
+    @staticmethod
+    def _trace_event(trace, kind, payload):
+        trace.mark("time_to_first_event")
+        if kind == "text":
+            trace.mark("time_to_first_text")
+            trace.count("output_events")
+            trace.count("output_chars", len(payload))
+        if kind == "citation":
+            trace.count("citations")
 
-        output_text, references = self.add_references(full_text, text_pieces)
+    def _finish_references(self, full_text, citations, trace):
+        render_segment = self.render_segment
+        if render_segment is not None:
+            def render_segment(segment):
+                with trace.span("render"):
+                    return self.render_segment(segment)
+
+        with trace.span("citation_processing"):
+            output_text, references = self.add_references(full_text, self.citations_to_text_pieces(citations), render_segment)
+        trace.count("references", len(references))
+        return output_text, references
+
+    def stream_data(self, kb_response, trace=None):
+        trace = trace if trace is not None else RequestTrace("stream_data")
+        citations = []
+        session_id = kb_response.get("sessionId")
+
+        text_parts = []
+        with trace.span("stream"):
+            for kind, payload in self.iter_stream_events(kb_response):
+                self._trace_event(trace, kind, payload)
+                if kind == "text":
+                    text_parts.append(payload)
+                if kind == "citation":
+                    citations.append(payload)
+
+        output_text, references = self._finish_references("".join(text_parts), citations, trace)
         return session_id, output_text, references
 
-    def chat_with_model(self, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None):
-        cfg = self.config["bedrock_configuration"]
-        cfg_orchestration = cfg.get("orchestration_config", {})
-        cfg_generation = cfg.get("generation_config", {})
-
-        inference_model_id = cfg.get("inference_model_id", None)
-        rerank_model_id = cfg.get("rerank_model_id", None)
-        kb_id = cfg.get("kb_id", None)
-        search_type = cfg.get("search_type", None)
-        n_source_chunks = cfg.get("n_source_chunks", None)
-        n_re_ranked_docs = cfg.get("n_re_ranked_docs", None)
-        generation_max_tokens = cfg_generation.get("model_config", {}).get("max_tokens", None)
-        generation_temp = cfg_generation.get("model_config", {}).get("temp", None)
-        generation_top_p = cfg_generation.get("model_config", {}).get("top_p", None)
-        orchestration_max_tokens = cfg_orchestration.get("model_config", {}).get("max_tokens", None)
-        orchestration_temp = cfg_orchestration.get("model_config", {}).get("temp", None)
-        orchestration_top_p = cfg_orchestration.get("model_config", {}).get("top_p", None)
-        query_split_type = cfg.get("bedrock_query_split_type", None)
-        guardrail_id = cfg.get("guardrail_id", None)
-        guardrail_version = cfg.get("guardrail_version", None)
-        current_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
-
-        # Input Params
-        generation_prompt = generation_prompt.replace("{current_time}", current_time)
-        orchestration_prompt = orchestration_prompt.replace("{current_time}", current_time)
-
-        generation_model_arn = f"arn:aws:bedrock:{self.aws_region}:{self.account_id}:inference-profile/{inference_model_id}"
-        rerank_model_arn = f"arn:aws:bedrock:{self.aws_region}::foundation-model/{rerank_model_id}"
-
-        # print("Inside br call", br_session_id)
-
-        # Build vectorSearchConfiguration
-        vector_search_config = {
-            "overrideSearchType": search_type,
-            "numberOfResults": n_source_chunks,
-            "rerankingConfiguration": {
-                "bedrockRerankingConfiguration": {
-                    "modelConfiguration": {
-                        "modelArn": rerank_model_arn,
-                    },
-                    "numberOfRerankedResults": n_re_ranked_docs,
-                },
-                "type": "BEDROCK_RERANKING_MODEL",
-            },
-        }
+    def stream_data_incremental(self, kb_response, result, trace=None):
+        """Yield output text deltas as soon as Bedrock sends them.
 
-        # Build the main configuration
-        knowledge_base_config = {
-            "knowledgeBaseId": kb_id,
-            "modelArn": generation_model_arn,
-            "generationConfiguration": {
-                "inferenceConfig": {
-                    "textInferenceConfig": {
-                        "maxTokens": generation_max_tokens,
-                        "temperature": generation_temp,
-                        "topP": generation_top_p,
-                    }
-                },
-                "promptTemplate": {"textPromptTemplate": f"""{generation_prompt}"""},
-            },
-            "retrievalConfiguration": {"vectorSearchConfiguration": vector_search_config},
-            "orchestrationConfiguration": {
-                "inferenceConfig": {
-                    "textInferenceConfig": {"maxTokens": orchestration_max_tokens, "temperature": orchestration_temp, "topP": orchestration_top_p}},
-                "promptTemplate": {
-                    "textPromptTemplate": f"""{orchestration_prompt}"""
-                },
-                "queryTransformationConfiguration": {"type": query_split_type},
-            },
-        }
+        ``result`` is filled in place: ``session_id`` straight away, ``citations`` as citation events arrive, and
+        ``text`` / ``references`` (the text with reference links patched in) and ``plain_text`` (the deltas joined)
+        once the stream is exhausted. If the stream fails part way, these hold what was received before the error is
+        re-raised.
+        """
+        trace = trace if trace is not None else RequestTrace("stream_data")
+        result["session_id"] = kb_response.get("sessionId")
+        result["citations"] = []
+        text_parts = []
+        try:
+            with trace.span("stream"):
+                for kind, payload in self.iter_stream_events(kb_response):
+                    self._trace_event(trace, kind, payload)
+                    if kind == "text":
+                        text_parts.append(payload)
+                        yield payload
+                    if kind == "citation":
+                        result["citations"].append(payload)
+        except Exception:
+            result["plain_text"] = "".join(text_parts)
+            result["text"], result["references"] = self._finish_references(result["plain_text"], result["citations"], trace)
+            raise
+
+        result["plain_text"] = "".join(text_parts)
+        output_text, references = self._finish_references(result["plain_text"], result["citations"], trace)
+        result["text"] = output_text
+        result["references"] = references
 
-        if cfg.get("enable_guardrails"):
-            knowledge_base_config["generationConfiguration"]["guardrailConfiguration"] = {"guardrailId": guardrail_id, "guardrailVersion": guardrail_version}
+    def answer_cache_scope(self, generation_prompt, orchestration_prompt, retrieval_profile=None, snapshot=None):
+        settings, template = snapshot or self.snapshot()
+        model_scope = template["retrieval"][retrieval_profile]["cache_model_scope"]
+        return make_scope(settings.bedrock.kb_id, generation_prompt, orchestration_prompt, model_scope)
 
-        retrieve_and_generate_config = {"type": "KNOWLEDGE_BASE", "knowledgeBaseConfiguration": knowledge_base_config}
+    def lookup_cached_answer(self, br_session_id, new_text, generation_prompt, orchestration_prompt, retrieval_profile=None,
+                             stateless=False, snapshot=None):
+        """Return the cached {"text", "references"} for a question, or None.
 
-        # Build the arguments for the function call
-        kwargs = {"input": {"text": new_text}, "retrieveAndGenerateConfiguration": retrieve_and_generate_config}
+        Only `stateless` questions that start a conversation are cached. With a Bedrock session the answer depends on
+        the chat history, which the cache key does not capture. A cached answer comes without a Bedrock session, so a
+        caller that may ask follow-ups (the chat UI) would lose the conversation context from the second turn on.
+        """
+        if self.answer_cache is None or br_session_id is not None or not stateless:
+            return None
+        scope = self.answer_cache_scope(generation_prompt, orchestration_prompt, retrieval_profile, snapshot)
+        return self.answer_cache.lookup(new_text, scope)
+
+    def store_cached_answer(self, br_session_id, new_text, generation_prompt, orchestration_prompt, text, references,
+                            retrieval_profile=None, stateless=False, snapshot=None, plain_text=None):
+        """Cache an answer; `plain_text` is the answer without reference links, which streamed hits return as a whole."""
+        if self.answer_cache is None or br_session_id is not None or not stateless:
+            return
+        scope = self.answer_cache_scope(generation_prompt, orchestration_prompt, retrieval_profile, snapshot)
+        value = {"text": text, "references": references}
+        if plain_text is not None:
+            value["plain_text"] = plain_text
+        self.answer_cache.store(new_text, scope, value)
+
+    def build_vector_search_config(self, retrieval_profile=None, snapshot=None):
+        _, template = snapshot or self.snapshot()
+        return template["retrieval"][retrieval_profile]["vector_search"]
+
+    def resolve_retrieval_profile(self, requested, new_text, snapshot=None):
+        """Return (profile name or None, chosen automatically) for a question; see retrieval_profiles."""
+        settings, _ = snapshot or self.snapshot()
+        profile, auto = resolve_retrieval_profile(settings, requested, new_text)
+        return (profile.name if profile else None), auto
+
+    def build_request(self, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, retrieval_profile=None,
+                      snapshot=None):
+        """Fill the compiled request template with the question, the session and the timestamped prompts.
+
+        `retrieval_profile` is the name of a configured retrieval profile, or None for bedrock_configuration's own
+        retrieval settings. `snapshot` is the request's snapshot(), which the profile was resolved against.
+        """
+        settings, template = snapshot or self.snapshot()
+        bedrock = settings.bedrock
+        retrieval = template["retrieval"][retrieval_profile]
+        generation_prompt = generation_prompt or bedrock.generation_prompt
+        orchestration_prompt = orchestration_prompt or bedrock.orchestration_prompt
+        if "{current_time}" in generation_prompt or "{current_time}" in orchestration_prompt:
+            current_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+            generation_prompt = generation_prompt.replace("{current_time}", current_time)
+            orchestration_prompt = orchestration_prompt.replace("{current_time}", current_time)
+
+        knowledge_base_config = {
+            **retrieval["knowledge_base"],
+            "generationConfiguration": {**template["generation"], "promptTemplate": {"textPromptTemplate": generation_prompt}},
+            "orchestrationConfiguration": {**retrieval["orchestration"], "promptTemplate": {"textPromptTemplate": orchestration_prompt}},
+        }
+        kwargs = {
+            "input": {"text": new_text},
+            "retrieveAndGenerateConfiguration": {"type": "KNOWLEDGE_BASE", "knowledgeBaseConfiguration": knowledge_base_config},
+        }
 
         # Conditionally add sessionId if available
         if br_session_id is not None:
             kwargs["sessionId"] = str(br_session_id)
 
-        # Call the function
-        response = self.bedrock_agent_runtime_client.retrieve_and_generate_stream(**kwargs)
+        return kwargs
+
+    def _start_trace(self, new_text, retrieval_profile, streaming, snapshot):
+        profile, auto = self.resolve_retrieval_profile(retrieval_profile, new_text, snapshot)
+        trace = RequestTrace(
+            "chat_with_model", variant=profile, kb_id=snapshot[0].bedrock.kb_id, streaming=streaming, retrieval_profile=profile,
+            auto_profile=auto,
+        )
+        return trace, profile
 
-        # Process the streaming data
-        br_session_id, text_with_references, citations = self.stream_data(response)
+    def chat_with_model(self, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, retrieval_profile=None,
+                        stateless=False):
+        """Ask a question; `retrieval_profile` is a profile name, "auto" to classify the question, or None for the
+        configured default. Pass `stateless=True` when no follow-up will be asked on the returned session (e.g. batch
+        runs): only those questions use the answer cache."""
+        snapshot = self.snapshot()
+        trace, profile = self._start_trace(new_text, retrieval_profile, False, snapshot)
+        cached = self.lookup_cached_answer(
+            br_session_id, new_text, generation_prompt, orchestration_prompt, profile, stateless, snapshot
+        )
+        if cached is not None:
+            trace.finish(cache_hit=True)
+            return br_session_id, cached["text"], cached["references"]
+
+        try:
+            with trace.span("config_build"):
+                kwargs = self.build_request(br_session_id, new_text, generation_prompt, orchestration_prompt, profile, snapshot)
+
+            # Call the function
+            with trace.span("request_send"):
+                response = self.bedrock_agent_runtime_client.retrieve_and_generate_stream(**kwargs)
+
+            # Process the streaming data
+            new_session_id, text_with_references, citations = self.stream_data(response, trace)
+        except Exception as e:
+            trace.finish(cache_hit=False, error=type(e).__name__)
+            raise
+        self.store_cached_answer(
+            br_session_id, new_text, generation_prompt, orchestration_prompt, text_with_references, citations, profile, stateless,
+            snapshot,
+        )
+        trace.finish(cache_hit=False)
+
+        return new_session_id, text_with_references, citations
+
+    def chat_with_model_stream(self, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, result=None,
+                               retrieval_profile=None, stateless=False):
+        """Same request as chat_with_model, but returns a generator of text deltas (see stream_data_incremental).
+
+        The request itself is sent before this returns, so API errors surface here rather than mid-iteration.
+        """
+        snapshot = self.snapshot()
+        trace, profile = self._start_trace(new_text, retrieval_profile, True, snapshot)
+        result = result if result is not None else {}
+        result["retrieval_profile"] = profile
+        cached = self.lookup_cached_answer(
+            br_session_id, new_text, generation_prompt, orchestration_prompt, profile, stateless, snapshot
+        )
+        if cached is not None:
+            # The stream yields nothing: the whole answer is in `result`, with `cache_hit` set
+            result.update(
+                session_id=br_session_id, citations=[], text=cached["text"], references=cached["references"],
+                plain_text=cached.get("plain_text", cached["text"]), cache_hit=True,
+            )
+            trace.finish(cache_hit=True)
+            return self._empty_stream()
+        result["cache_hit"] = False
+
+        try:
+            with trace.span("config_build"):
+                kwargs = self.build_request(br_session_id, new_text, generation_prompt, orchestration_prompt, profile, snapshot)
+            with trace.span("request_send"):
+                response = self.bedrock_agent_runtime_client.retrieve_and_generate_stream(**kwargs)
+        except Exception as e:
+            trace.finish(cache_hit=False, error=type(e).__name__)
+            raise
+        return self._finish_stream(
+            self.stream_data_incremental(response, result, trace), result, trace,
+            br_session_id, new_text, generation_prompt, orchestration_prompt, profile, stateless, snapshot,
+        )
+
+    @staticmethod
+    def _empty_stream():
+        yield from ()
 
-        return br_session_id, text_with_references, citations
+    def _finish_stream(self, text_stream, result, trace, br_session_id, new_text, generation_prompt, orchestration_prompt,
+                       retrieval_profile, stateless, snapshot):
+        completed = False
+        try:
+            yield from text_stream
+            completed = True
+        except Exception as e:
+            trace.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            # Also reached when the consumer closes the generator early, in which case nothing is cached
+            trace.finish(cache_hit=False, completed=completed)
+        self.store_cached_answer(
+            br_session_id, new_text, generation_prompt, orchestration_prompt, result["text"], result["references"], retrieval_profile,
+            stateless, snapshot, result["plain_text"],
+        )
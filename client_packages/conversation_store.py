@@ -0,0 +1,253 @@
+import re
+import json
+import time
+import sqlite3
+import importlib
+import threading
+from abc import ABC, abstractmethod
+
+_markup_regex = re.compile(r"<br\s*/?>|<[^>]+>|\\(?=\$)")
+
+
+class ConversationStore(ABC):
+    """Interface of the persistent conversation stores; see SQLiteConversationStore for the default implementation.
+
+    Conversations are identified by (user, session_name) and hold the Bedrock session id of their latest turn, so a
+    resumed conversation can keep using it while Bedrock still remembers it.
+    """
+
+    @abstractmethod
+    def create_conversation(self, user, session_name, pipeline=None):
+        """Create a conversation and return its id; returns None if the user already has one with that name."""
+
+    @abstractmethod
+    def find_conversation(self, user, session_name):
+        """Id of the user's conversation called `session_name`, or None."""
+
+    @abstractmethod
+    def rename_conversation(self, conversation_id, session_name):
+        """Rename a conversation; returns False if the user already has one with that name."""
+
+    @abstractmethod
+    def append_turn(self, conversation_id, role, text, references=None, unique_id=None, bedrock_session_id=None,
+                    pipeline=None, rendered_text=None):
+        """Append one turn; a given Bedrock session id and pipeline replace the conversation's current ones.
+
+        `text` is the plain text that is searched and shown in search results; `rendered_text`, when given, is the
+        version with reference links that load_turns returns for replay.
+        """
+
+    @abstractmethod
+    def list_conversations(self, user, limit=20):
+        """Most recently updated conversations of a user, as dicts."""
+
+    @abstractmethod
+    def get_conversation(self, conversation_id):
+        """A conversation as a dict, or None."""
+
+    @abstractmethod
+    def load_turns(self, conversation_id):
+        """Turns of a conversation in order, as dicts with role, text (the rendered text if any), references and
+        unique_id."""
+
+    @abstractmethod
+    def search(self, user, query, limit=20):
+        """Turns of the user's conversations matching `query`, best matches first."""
+
+
+class SQLiteConversationStore(ConversationStore):
+    """Conversation store in a single SQLite file, with an FTS5 index over turn text when SQLite supports it."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS conversations (
+                id INTEGER PRIMARY KEY,
+                user TEXT NOT NULL,
+                session_name TEXT NOT NULL,
+                pipeline TEXT,
+                bedrock_session_id TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                UNIQUE (user, session_name)
+            );
+            CREATE INDEX IF NOT EXISTS conversations_user_updated ON conversations (user, updated_at);
+            CREATE TABLE IF NOT EXISTS turns (
+                id INTEGER PRIMARY KEY,
+                conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+                role TEXT NOT NULL,
+                text TEXT NOT NULL,
+                rendered_text TEXT,
+                references_json TEXT,
+                unique_id TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS turns_conversation ON turns (conversation_id, id);
+            """
+        )
+        self.full_text_search = self._create_fts()
+        self._add_rendered_text()
+        self._conn.commit()
+
+    def _create_fts(self):
+        try:
+            self._conn.executescript(
+                """
+                CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5 (
+                    text, content='turns', content_rowid='id', tokenize='porter unicode61'
+                );
+                CREATE TRIGGER IF NOT EXISTS turns_fts_insert AFTER INSERT ON turns BEGIN
+                    INSERT INTO turns_fts (rowid, text) VALUES (new.id, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS turns_fts_delete AFTER DELETE ON turns BEGIN
+                    INSERT INTO turns_fts (turns_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                END;
+                """
+            )
+            return True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5: search falls back to LIKE
+            return False
+
+    def _add_rendered_text(self):
+        # Stores created before rendered_text held the rendered HTML in `text`: move it over, keep the tag-stripped
+        # text in `text`, and reindex it
+        if "rendered_text" in {row["name"] for row in self._conn.execute("PRAGMA table_info(turns)")}:
+            return
+        self._conn.execute("ALTER TABLE turns ADD COLUMN rendered_text TEXT")
+        rows = self._conn.execute("SELECT id, text FROM turns WHERE role = 'assistant'").fetchall()
+        self._conn.executemany(
+            "UPDATE turns SET rendered_text = ?, text = ? WHERE id = ?",
+            [(row["text"], strip_markup(row["text"]), row["id"]) for row in rows],
+        )
+        if self.full_text_search:
+            self._conn.execute("INSERT INTO turns_fts (turns_fts) VALUES ('rebuild')")
+
+    def create_conversation(self, user, session_name, pipeline=None):
+        now = time.time()
+        with self._lock:
+            try:
+                cursor = self._conn.execute(
+                    "INSERT INTO conversations (user, session_name, pipeline, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (user, session_name, pipeline, now, now),
+                )
+                self._conn.commit()
+                return cursor.lastrowid
+            except sqlite3.IntegrityError:
+                self._conn.rollback()
+                return None
+
+    def find_conversation(self, user, session_name):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM conversations WHERE user = ? AND session_name = ?", (user, session_name)
+            ).fetchone()
+        return row["id"] if row else None
+
+    def rename_conversation(self, conversation_id, session_name):
+        with self._lock:
+            try:
+                self._conn.execute("UPDATE conversations SET session_name = ? WHERE id = ?", (session_name, conversation_id))
+                self._conn.commit()
+                return True
+            except sqlite3.IntegrityError:
+                self._conn.rollback()
+                return False
+
+    def append_turn(self, conversation_id, role, text, references=None, unique_id=None, bedrock_session_id=None,
+                    pipeline=None, rendered_text=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO turns (conversation_id, role, text, rendered_text, references_json, unique_id, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (conversation_id, role, text, rendered_text, json.dumps(references) if references else None,
+                 str(unique_id) if unique_id else None, now),
+            )
+            self._conn.execute(
+                "UPDATE conversations SET updated_at = ?, bedrock_session_id = COALESCE(?, bedrock_session_id), "
+                "pipeline = COALESCE(?, pipeline) WHERE id = ?",
+                (now, bedrock_session_id, pipeline, conversation_id),
+            )
+            self._conn.commit()
+
+    def list_conversations(self, user, limit=20):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM conversations WHERE user = ? ORDER BY updated_at DESC LIMIT ?", (user, limit)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_conversation(self, conversation_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return dict(row) if row else None
+
+    def load_turns(self, conversation_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT role, COALESCE(rendered_text, text) AS text, references_json, unique_id FROM turns "
+                "WHERE conversation_id = ? ORDER BY id",
+                (conversation_id,),
+            ).fetchall()
+        return [
+            {
+                "role": row["role"],
+                "text": row["text"],
+                "references": json.loads(row["references_json"]) if row["references_json"] else [],
+                "unique_id": row["unique_id"],
+            }
+            for row in rows
+        ]
+
+    def search(self, user, query, limit=20):
+        columns = "c.id AS conversation_id, c.session_name, c.updated_at, t.role, t.text"
+        with self._lock:
+            if self.full_text_search:
+                # Quote every term so user input cannot be read as FTS query syntax
+                fts_query = " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+                if not fts_query:
+                    return []
+                rows = self._conn.execute(
+                    f"SELECT {columns} FROM turns_fts JOIN turns t ON t.id = turns_fts.rowid "
+                    "JOIN conversations c ON c.id = t.conversation_id "
+                    "WHERE turns_fts MATCH ? AND c.user = ? ORDER BY turns_fts.rank LIMIT ?",
+                    (fts_query, user, limit),
+                ).fetchall()
+            else:
+                rows = self._conn.execute(
+                    f"SELECT {columns} FROM turns t JOIN conversations c ON c.id = t.conversation_id "
+                    "WHERE t.text LIKE ? AND c.user = ? ORDER BY t.id DESC LIMIT ?",
+                    (f"%{query}%", user, limit),
+                ).fetchall()
+        return [dict(row) for row in rows]
+
+
+def strip_markup(text):
+    """Plain text of a rendered answer: HTML tags removed, <br> as newlines and markdown-escaped "$" unescaped."""
+    return _markup_regex.sub(lambda match: "\n" if match.group().startswith("<br") else "", text)
+
+
+def build_conversation_store(store_config, base_dir):
+    """Build the store named by `conversation_store.backend`: "sqlite", "none", or "package.module:ClassName" of a
+    ConversationStore subclass, which gets the section's `options` as keyword arguments."""
+    store_config = store_config or {}
+    backend = store_config.get("backend", "sqlite")
+    if backend in (None, "none"):
+        return None
+    if backend == "sqlite":
+        path = base_dir / store_config.get("sqlite_path", "data/conversations.sqlite3")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return SQLiteConversationStore(path)
+    module_name, class_name = backend.split(":")
+    return getattr(importlib.import_module(module_name), class_name)(**store_config.get("options", {}))
+
+
+def bedrock_session_is_valid(conversation, ttl_hours):
+    """Whether the conversation's Bedrock session id is recent enough for Bedrock to still hold its history."""
+    return bool(conversation.get("bedrock_session_id")) and time.time() - conversation["updated_at"] < ttl_hours * 3600
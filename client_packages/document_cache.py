@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from urllib.parse import urlparse
+from concurrent.futures import Future
+from botocore.exceptions import ClientError
+from client_packages.telemetry import RequestTrace
+
+NOT_MODIFIED_CODES = {"304", "NotModified"}
+NOT_FOUND_CODES = {"404", "NoSuchKey", "NoSuchBucket"}
+
+
+class DocumentTooLarge(Exception):
+    """Raised when an object is bigger than the `max_size` a caller allowed for it."""
+
+
+def parse_s3_path(s3_path):
+    parsed_url = urlparse(s3_path)
+    return parsed_url.netloc, parsed_url.path.lstrip('/')
+
+
+class DocumentCache:
+    """Local cache of S3 documents, keyed by bucket/key and validated against the object's ETag.
+
+    Files are stored content-addressed under `blobs/` (named by the SHA-256 of their bytes), so identical objects
+    under different keys are stored once and same-named objects under different keys never collide. `index.json` maps
+    each bucket/key to its ETag and blob. Entries validated within `revalidate_after_seconds` are served without
+    touching S3; older ones are revalidated with a conditional GET. Least recently used entries are evicted once the
+    blobs exceed `max_bytes`, and concurrent fetches of the same object share a single download when the download's
+    size limit is no stricter than their own.
+    """
+
+    def __init__(self, root, s3_client, max_bytes=2 * 1024 ** 3, revalidate_after_seconds=300):
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.tmp_dir = self.root / "tmp"
+        self.index_path = self.root / "index.json"
+        self.s3_client = s3_client
+        self.max_bytes = max_bytes
+        self.revalidate_after_seconds = revalidate_after_seconds
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        # Drop entries whose blob was removed behind our back
+        return {k: v for k, v in index.items() if (self.blob_dir / v["blob"]).exists()}
+
+    def _save_index(self):
+        # Called with the lock held
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def entry_key(bucket, key):
+        return f"{bucket}/{key}"
+
+    def cached_path(self, s3_path):
+        """Path of the cached copy of `s3_path` without contacting S3, or None if it is not cached."""
+        with self._lock:
+            entry = self._index.get(self.entry_key(*parse_s3_path(s3_path)))
+        return str(self.blob_dir / entry["blob"]) if entry else None
+
+    def fetch(self, s3_path, max_size=None):
+        """Return the local path of `s3_path`, downloading or revalidating it when needed.
+
+        :param s3_path: s3://bucket/key URI.
+        :param max_size: Optional size limit in bytes; larger objects raise DocumentTooLarge without being stored.
+        :return: Path to the cached file.
+        :raises FileNotFoundError: If the object does not exist.
+        """
+        trace = RequestTrace("s3_fetch", source=s3_path)
+        bucket, key = parse_s3_path(s3_path)
+        entry_key = self.entry_key(bucket, key)
+        with self._lock:
+            entry = self._index.get(entry_key)
+            if entry and time.time() - entry["validated_at"] < self.revalidate_after_seconds:
+                entry["last_access"] = time.time()
+                trace.finish(outcome="cache_hit")
+                return str(self.blob_dir / entry["blob"])
+            inflight = self._inflight.get(entry_key)
+            future = shared = None
+            if inflight is None:
+                future = Future()
+                self._inflight[entry_key] = (future, max_size)
+            elif inflight[1] is None or (max_size is not None and max_size <= inflight[1]):
+                # The running download can only fail on size where this call would too
+                shared = inflight[0]
+            # Otherwise a download with a stricter limit (e.g. a prefetch) is running: download separately
+
+        if shared is not None:
+            try:
+                return shared.result()
+            finally:
+                trace.finish(outcome="shared_download")
+
+        try:
+            with trace.span("s3_get"):
+                path = self._fetch(bucket, key, entry_key, entry, max_size, trace)
+            if future is not None:
+                future.set_result(path)
+            return path
+        except BaseException as e:
+            trace.finish(outcome="error", error=type(e).__name__)
+            if future is not None:
+                future.set_exception(e)
+            raise
+        finally:
+            trace.finish()
+            if future is not None:
+                with self._lock:
+                    self._inflight.pop(entry_key, None)
+
+    def _fetch(self, bucket, key, entry_key, entry, max_size, trace):
+        kwargs = {"Bucket": bucket, "Key": key}
+        if entry:
+            kwargs["IfNoneMatch"] = entry["etag"]
+        try:
+            response = self.s3_client.get_object(**kwargs)
+        except ClientError as e:
+            code = e.response.get("Error", {}).get("Code")
+            if entry and code in NOT_MODIFIED_CODES:
+                with self._lock:
+                    entry["validated_at"] = entry["last_access"] = time.time()
+                    self._save_index()
+                trace.attributes["outcome"] = "not_modified"
+                return str(self.blob_dir / entry["blob"])
+            if code in NOT_FOUND_CODES:
+                raise FileNotFoundError(f"s3://{bucket}/{key}") from e
+            raise
+
+        body = response["Body"]
+        if max_size is not None and response.get("ContentLength", 0) > max_size:
+            body.close()
+            raise DocumentTooLarge(f"s3://{bucket}/{key} is {response['ContentLength']} bytes")
+
+        # Stream into a temp file while hashing, then move it into place atomically
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in body.iter_chunks(chunk_size=1024 * 1024):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            blob = digest.hexdigest() + Path(key).suffix.lower()
+            os.replace(tmp_path, self.blob_dir / blob)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        trace.attributes["outcome"] = "downloaded"
+        trace.count("bytes", size)
+        now = time.time()
+        with self._lock:
+            previous = self._index.get(entry_key)
+            self._index[entry_key] = {
+                "etag": response.get("ETag"),
+                "blob": blob,
+                "size": size,
+                "last_access": now,
+                "validated_at": now,
+            }
+            # A new version of the object leaves the old blob unreferenced, and _evict only sees referenced blobs
+            if previous is not None and previous["blob"] != blob:
+                self._unlink_if_unused(previous["blob"])
+            self._evict(keep=entry_key)
+            self._save_index()
+        return str(self.blob_dir / blob)
+
+    def _unlink_if_unused(self, blob):
+        # Called with the lock held
+        if all(entry["blob"] != blob for entry in self._index.values()):
+            (self.blob_dir / blob).unlink(missing_ok=True)
+            return True
+        return False
+
+    def _evict(self, keep=None):
+        # Called with the lock held; blobs are shared between entries with identical content
+        blob_sizes = {entry["blob"]: entry["size"] for entry in self._index.values()}
+        total = sum(blob_sizes.values())
+        for entry_key, entry in sorted(self._index.items(), key=lambda item: item[1]["last_access"]):
+            if total <= self.max_bytes:
+                break
+            if entry_key == keep:
+                continue
+            del self._index[entry_key]
+            if self._unlink_if_unused(entry["blob"]):
+                total -= entry["size"]
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+from client_packages.request_engine import is_retryable_error
+from client_packages.split_pipeline import SplitPipelineChat
+from client_packages.telemetry import RequestTrace, logger
+
+
+class FederatedPipelineChat(SplitPipelineChat):
+    """Answers from several knowledge bases at once, e.g. one per department.
+
+    Retrieval runs against every knowledge base in parallel, so it takes about as long as the slowest one. The results
+    are merged, reranked across knowledge bases, and answered with a single Converse call, as in SplitPipelineChat.
+    Each chunk's metadata records the knowledge base it came from, and its S3 location is kept as is. References
+    built by add_references therefore show their knowledge base and open from their own bucket.
+    """
+
+    trace_name = "federated_pipeline"
+
+    def __init__(self, kb_chat, knowledge_bases, context_cache=None, rerank=True, max_workers=None, **kwargs):
+        """`knowledge_bases` maps a display name to a knowledge base id; all of them are in the Bedrock region."""
+        if not knowledge_bases:
+            raise ValueError("FederatedPipelineChat needs at least one knowledge base")
+        super().__init__(kb_chat, context_cache, **kwargs)
+        self.knowledge_bases = dict(knowledge_bases)
+        self.rerank = rerank
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or len(self.knowledge_bases), thread_name_prefix="kb-fan-out"
+        )
+
+    def _retrieve_one(self, name, kb_id, query, vector_search_config, trace):
+        with trace.span(f"retrieve.{name}"):
+            response = self.kb_chat.bedrock_agent_runtime_client.retrieve(
+                knowledgeBaseId=kb_id,
+                retrievalQuery={"text": query},
+                retrievalConfiguration={"vectorSearchConfiguration": vector_search_config},
+            )
+        return [
+            {
+                "content": result["content"],
+                "location": result["location"],
+                "metadata": {**result.get("metadata", {}), "knowledge_base": name, "knowledge_base_id": kb_id},
+                "score": result.get("score", 0.0),
+            }
+            for result in response.get("retrievalResults", [])
+        ]
+
+    def retrieve(self, query, retrieval_profile=None, trace=None, snapshot=None):
+        """Retrieve from every knowledge base concurrently and return the best chunks across all of them.
+
+        A knowledge base that fails with a non-retryable error (e.g. access denied) is logged and left out, and listed
+        in the trace's `failed_knowledge_bases`. Throttling and service errors are raised instead, so the request engine
+        retries the whole request rather than answering without that knowledge base; so is any error when all of them
+        fail.
+        """
+        own_trace = trace is None
+        trace = RequestTrace(f"{self.trace_name}.retrieve") if own_trace else trace
+        vector_search_config = self.kb_chat.build_vector_search_config(retrieval_profile, snapshot)
+        reranking = vector_search_config["rerankingConfiguration"]["bedrockRerankingConfiguration"]
+        if self.rerank:
+            # Every knowledge base returns its unranked candidates, and one rerank call ranks them all together
+            vector_search_config = {k: v for k, v in vector_search_config.items() if k != "rerankingConfiguration"}
+        futures = {
+            name: self._executor.submit(self._retrieve_one, name, kb_id, query, vector_search_config, trace)
+            for name, kb_id in self.knowledge_bases.items()
+        }
+
+        chunks = []
+        failed = {}
+        for name, future in futures.items():
+            try:
+                chunks.extend(future.result())
+            except Exception as e:
+                failed[name] = e
+                logger.warning("Knowledge base retrieval failed", extra={"knowledge_base": name, "error": str(e)})
+        if failed:
+            trace.attributes["failed_knowledge_bases"] = sorted(failed)
+            retryable = [e for e in failed.values() if is_retryable_error(e)]
+            if retryable or len(failed) == len(futures):
+                error = (retryable or list(failed.values()))[0]
+                if own_trace:
+                    trace.finish(error=type(error).__name__)
+                raise error
+        trace.count("candidate_chunks", len(chunks))
+
+        n_results = reranking["numberOfRerankedResults"]
+        if self.rerank and chunks:
+            with trace.span("rerank"):
+                chunks = self.rerank_chunks(query, chunks, reranking["modelConfiguration"]["modelArn"], n_results)
+        else:
+            # Scores of chunks reranked within one knowledge base are comparable enough to merge on
+            chunks = sorted(chunks, key=lambda chunk: chunk["score"], reverse=True)[:n_results]
+        if own_trace:
+            trace.finish()
+        return [{k: v for k, v in chunk.items() if k != "score"} for chunk in chunks]
+
+    def rerank_chunks(self, query, chunks, model_arn, n_results):
+        response = self.kb_chat.bedrock_agent_runtime_client.rerank(
+            queries=[{"type": "TEXT", "textQuery": {"text": query}}],
+            sources=[
+                {"type": "INLINE", "inlineDocumentSource": {"type": "TEXT", "textDocument": {"text": chunk["content"]["text"]}}}
+                for chunk in chunks
+            ],
+            rerankingConfiguration={
+                "type": "BEDROCK_RERANKING_MODEL",
+                "bedrockRerankingConfiguration": {
+                    "numberOfResults": min(n_results, len(chunks)),
+                    "modelConfiguration": {"modelArn": model_arn},
+                },
+            },
+        )
+        return [
+            {**chunks[result["index"]], "score": result["relevanceScore"]}
+            for result in sorted(response["results"], key=lambda result: result["relevanceScore"], reverse=True)
+        ]
+
+    def _result_attributes(self, trace):
+        return {**super()._result_attributes(trace), "failed_knowledge_bases": trace.attributes.get("failed_knowledge_bases", [])}
+
+    def _start_trace(self, new_text, retrieval_profile, streaming, snapshot):
+        trace, profile = super()._start_trace(new_text, retrieval_profile, streaming, snapshot)
+        trace.attributes["knowledge_bases"] = sorted(self.knowledge_bases)
+        return trace, profile
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+
+class ChatHistory:
+    """Chat history of one Streamlit session, kept compact and bounded in memory.
+
+    Assistant messages store only reference keys; the reference text, source and metadata live once in a per-session
+    table, so a chunk cited by many answers is held once. Only the latest `max_in_memory_messages` messages are kept
+    in memory: older ones are appended, with their references inlined, to a JSON Lines spill file and read back
+    only when the user asks to see them.
+    """
+
+    def __init__(self, spill_path, max_in_memory_messages=40):
+        self.spill_path = Path(spill_path)
+        self.max_in_memory_messages = max_in_memory_messages
+        self.messages = []
+        self.spilled_count = 0
+        self.references = {}
+        self._reference_keys = {}
+        self._reference_counts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.spilled_count + len(self.messages)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def _reference_key(self, ref):
+        identity = (ref["source"], ref["text"])
+        key = self._reference_keys.get(identity)
+        if key is None:
+            key = self._reference_keys[identity] = str(len(self._reference_keys) + 1)
+            self.references[key] = {"text": ref["text"], "source": ref["source"], "metadata": ref.get("metadata", {})}
+            self._reference_counts[key] = 0
+        self._reference_counts[key] += 1
+        return key
+
+    def _release_reference(self, key):
+        self._reference_counts[key] -= 1
+        if self._reference_counts[key] == 0:
+            ref = self.references.pop(key)
+            del self._reference_counts[key]
+            del self._reference_keys[(ref["source"], ref["text"])]
+
+    def append_user(self, text, unique_id=None):
+        with self._lock:
+            self.messages.append({"role": "user", "text": text, "unique_id": str(unique_id) if unique_id else None})
+            self._spill()
+
+    def append_assistant(self, text, references, unique_id=None, session_id=None):
+        with self._lock:
+            self.messages.append({
+                "role": "assistant",
+                "text": text,
+                "references": [(ref["id"], self._reference_key(ref)) for ref in references],
+                "unique_id": str(unique_id) if unique_id else None,
+                "session_id": session_id,
+            })
+            self._spill()
+
+    def resolve_references(self, message):
+        """The message's references in the {"id", "text", "source", "metadata"} shape add_references produces."""
+        if "resolved_references" in message:
+            return message["resolved_references"]
+        return [{"id": ref_id, **self.references[key]} for ref_id, key in message.get("references", [])]
+
+    def _spill(self):
+        # Called with the lock held
+        overflow = len(self.messages) - self.max_in_memory_messages
+        if overflow <= 0:
+            return
+        spilled, self.messages = self.messages[:overflow], self.messages[overflow:]
+        self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.spill_path, "a") as f:
+            for message in spilled:
+                record = dict(message)
+                if message["role"] == "assistant":
+                    record["resolved_references"] = self.resolve_references(message)
+                    for _, key in message["references"]:
+                        self._release_reference(key)
+                    del record["references"]
+                f.write(json.dumps(record) + "\n")
+        self.spilled_count += overflow
+
+    def load_spilled(self):
+        """Messages that were moved to disk, oldest first."""
+        if not self.spilled_count or not self.spill_path.exists():
+            return []
+        with open(self.spill_path, "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def clear(self):
+        with self._lock:
+            self.messages = []
+            self.spilled_count = 0
+            self.references.clear()
+            self._reference_keys.clear()
+            self._reference_counts.clear()
+            self.spill_path.unlink(missing_ok=True)
+
+
+def purge_spill_files(spill_dir, max_age_seconds):
+    """Delete spill files of sessions untouched for `max_age_seconds` (their Streamlit sessions are long gone)."""
+    spill_dir = Path(spill_dir)
+    if not spill_dir.exists():
+        return
+    cutoff = time.time() - max_age_seconds
+    for entry in os.scandir(spill_dir):
+        if entry.is_file() and entry.name.endswith(".jsonl") and entry.stat().st_mtime < cutoff:
+            Path(entry.path).unlink(missing_ok=True)
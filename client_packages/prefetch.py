@@ -0,0 +1,57 @@
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from client_packages.document_cache import DocumentTooLarge
+from client_packages.telemetry import logger
+
+
+class DocumentPrefetcher:
+    """Warms a DocumentCache with the sources cited by an answer, before the user clicks on them.
+
+    Only file types listed in `max_size_by_type` are fetched (the ones the UI can open), each with its own size cap,
+    and at most `top_n` distinct sources per answer. Downloads run on a small bounded pool so prefetching never
+    competes with more than `max_workers` connections.
+    """
+
+    def __init__(self, document_cache, max_workers=4, top_n=3, max_size_by_type=None):
+        self.document_cache = document_cache
+        self.top_n = top_n
+        self.max_size_by_type = max_size_by_type or {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="document-prefetch")
+        self._lock = threading.Lock()
+        self._queued = set()
+
+    def select_sources(self, references):
+        """Distinct prefetchable sources in citation order, capped at `top_n`."""
+        sources = []
+        for ref in references:
+            source = ref["source"]
+            if source in sources or Path(source).suffix.lower().lstrip(".") not in self.max_size_by_type:
+                continue
+            sources.append(source)
+            if len(sources) == self.top_n:
+                break
+        return sources
+
+    def prefetch(self, references):
+        """Queue background downloads for the references of one answer and return their futures."""
+        futures = []
+        for source in self.select_sources(references):
+            with self._lock:
+                if source in self._queued:
+                    continue
+                self._queued.add(source)
+            futures.append(self._executor.submit(self._fetch, source))
+        return futures
+
+    def _fetch(self, source):
+        max_size = self.max_size_by_type[Path(source).suffix.lower().lstrip(".")]
+        try:
+            return self.document_cache.fetch(source, max_size=max_size)
+        except DocumentTooLarge:
+            logger.info("Skipped prefetch of oversized document", extra={"source": source, "max_size": max_size})
+        except Exception as e:
+            logger.warning("Prefetch failed", extra={"source": source, "error": str(e)})
+        finally:
+            with self._lock:
+                self._queued.discard(source)
@@ -0,0 +1,156 @@
+import re
+import json
+import time
+import itertools
+import pandas as pd
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"[ \t\n\r,]*")
+_number_chars = re.compile(r"[0-9.eE+-]*")
+
+
+def read_csv_page(file_path, page, page_size=100, chunksize=50000):
+    """Read one page (0-based) of a CSV, indexed by row number, holding at most `chunksize` rows in memory.
+
+    The rows before the page are parsed a chunk at a time and dropped; `skiprows` would instead build a set of every
+    skipped row number, so its cost grew with the page number.
+    """
+    start, stop = page * page_size, (page + 1) * page_size
+    pieces = []
+    with pd.read_csv(file_path, chunksize=chunksize) as reader:
+        for chunk in reader:
+            if chunk.empty or chunk.index[-1] < start:
+                continue
+            pieces.append(chunk.loc[start:stop - 1])
+            if chunk.index[-1] >= stop - 1:
+                break
+    if not pieces:
+        return pd.read_csv(file_path, nrows=0)
+    return pd.concat(pieces) if len(pieces) > 1 else pieces[0]
+
+
+def match_score(values, chunk_text):
+    """Fraction of the non-trivial values that appear as whole words in the cited chunk text."""
+    values = [str(v).strip() for v in values]
+    values = [v for v in values if len(v) > 1 and v.lower() != "nan"]
+    if not values:
+        return 0.0
+    found = sum(re.search(r"(?<!\w)" + re.escape(v) + r"(?!\w)", chunk_text) is not None for v in values if v in chunk_text)
+    return found / len(values)
+
+
+def find_csv_matches(file_path, chunk_text, chunksize=50000, max_matches=20, threshold=0.6, max_seconds=None):
+    """Row numbers (0-based, excluding the header) whose cells mostly appear in the cited chunk, scanned in chunks.
+
+    With `max_seconds`, the scan stops after the chunk during which that much time has passed.
+    """
+    deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+    matches = []
+    for chunk in pd.read_csv(file_path, chunksize=chunksize, dtype=str):
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        for row_number, row in zip(chunk.index, chunk.itertuples(index=False)):
+            if match_score(row, chunk_text) >= threshold:
+                matches.append(int(row_number))
+                if len(matches) == max_matches:
+                    return matches
+    return matches
+
+
+def _iter_json_values(f, buf, pos, buffer_size, end_char=None, object_keys=False):
+    # Incrementally decode the values of a top-level array/object (or a JSON Lines file) with bounded memory
+    eof = False
+    index = 0
+    while True:
+        pos = _whitespace.match(buf, pos).end()
+        if pos >= len(buf) - 1 and not eof:
+            more = f.read(buffer_size)
+            eof = not more
+            buf, pos = buf[pos:] + more, 0
+            continue
+        if pos >= len(buf) or (end_char and buf[pos] == end_char):
+            return
+        try:
+            start = pos
+            if object_keys:
+                key, pos = _decoder.raw_decode(buf, pos)
+                pos = _whitespace.match(buf, pos).end()
+                if buf[pos] != ":":
+                    raise json.JSONDecodeError("Expecting ':' delimiter", buf, pos)
+                pos = _whitespace.match(buf, pos + 1).end()
+            else:
+                key = index
+            value, end = _decoder.raw_decode(buf, pos)
+            if not eof and _number_chars.match(buf, end).end() == len(buf):
+                # The value may be a number cut off at the buffer boundary, possibly right after its "." or "e" (which
+                # then decodes as a shorter number): read more and decode it again
+                raise json.JSONDecodeError("Truncated value", buf, end)
+        except (json.JSONDecodeError, IndexError):
+            if eof:
+                raise
+            more = f.read(buffer_size)
+            eof = not more
+            buf, pos = buf[start:] + more, 0
+            continue
+        yield key, value
+        index += 1
+        pos = end
+
+
+def iter_json_items(file_path, buffer_size=1 << 16):
+    """Yield (key, value) for each top-level entry of a JSON file without parsing it all at once.
+
+    Objects yield their keys and arrays yield indices. .jsonl / .ndjson files, or any file whose top-level value is
+    neither, are read as JSON Lines (indices again).
+    """
+    lines = str(file_path).lower().endswith((".jsonl", ".ndjson"))
+    with open(file_path, "r") as f:
+        buf = f.read(buffer_size)
+        pos = _whitespace.match(buf, 0).end()
+        while pos == len(buf):
+            more = f.read(buffer_size)
+            if not more:
+                break
+            buf = more
+            pos = _whitespace.match(buf, 0).end()
+        if lines:
+            yield from _iter_json_values(f, buf, pos, buffer_size)
+        elif buf[pos:pos + 1] == "[":
+            yield from _iter_json_values(f, buf, pos + 1, buffer_size, end_char="]")
+        elif buf[pos:pos + 1] == "{":
+            yield from _iter_json_values(f, buf, pos + 1, buffer_size, end_char="}", object_keys=True)
+        else:
+            yield from _iter_json_values(f, buf, pos, buffer_size)
+
+
+def read_json_page(file_path, page, page_size=100):
+    """One page (0-based) of top-level entries, as a dict keyed like iter_json_items."""
+    return dict(itertools.islice(iter_json_items(file_path), page * page_size, (page + 1) * page_size))
+
+
+def json_leaves(value):
+    if isinstance(value, dict):
+        for item in value.values():
+            yield from json_leaves(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from json_leaves(item)
+    elif value is not None:
+        yield value
+
+
+def find_json_matches(file_path, chunk_text, max_matches=20, threshold=0.6, max_seconds=None):
+    """Top-level entries ({key: value}) whose leaf values mostly appear in the cited chunk text.
+
+    With `max_seconds`, the scan stops once that much time has passed.
+    """
+    deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+    matches = {}
+    for key, value in iter_json_items(file_path):
+        if deadline is not None and time.monotonic() > deadline:
+            break
+        if match_score(json_leaves(value), chunk_text) >= threshold:
+            matches[key] = value
+            if len(matches) == max_matches:
+                break
+    return matches
@@ -0,0 +1,358 @@
+import time
+import queue
+import random
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError, HTTPClientError
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+from client_packages.stream_guard import StreamTimeout
+from client_packages.telemetry import logger
+
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+SERVICE_ERROR_CODES = {
+    "InternalServerException", "ServiceUnavailableException", "BadGatewayException", "DependencyFailedException",
+    "ModelNotReadyException", "ModelTimeoutException",
+}
+# Streamed to the UI between the text of an interrupted answer and the text of its retry
+RESUME_NOTICE = "\n\n*(The answer was interrupted, retrying...)*\n\n"
+
+
+class RequestCancelled(Exception):
+    """Raised into a request's future when it is cancelled after it started running."""
+
+
+class CircuitOpenError(Exception):
+    """Raised into a request's future when the circuit breaker is refusing new Bedrock requests."""
+
+
+class StreamInterrupted(Exception):
+    """Raised into a streaming request's future when the answer broke off and `result` holds a partial answer."""
+
+
+def error_code(error):
+    code = error.response.get("Error", {}).get("Code", "") if isinstance(error, ClientError) else ""
+    # Errors raised inside an event stream use camelCase codes, e.g. "throttlingException"
+    return code[:1].upper() + code[1:]
+
+
+def is_throttling_error(error):
+    return error_code(error) in THROTTLING_ERROR_CODES
+
+
+def is_service_error(error):
+    """Bedrock failing or unreachable, as opposed to throttling or rejecting the request."""
+    if isinstance(error, (StreamTimeout, HTTPClientError, Urllib3HTTPError, ConnectionError)):
+        return True
+    return error_code(error) in SERVICE_ERROR_CODES
+
+
+def is_retryable_error(error):
+    return is_throttling_error(error) or is_service_error(error)
+
+
+def is_terminal_error(error):
+    """An error a request can end with once the engine has given up on it, as opposed to a bug in the app."""
+    return isinstance(error, (CircuitOpenError, StreamTimeout, ClientError, BotoCoreError, Urllib3HTTPError, ConnectionError))
+
+
+class CircuitBreaker:
+    """Fails requests fast while Bedrock keeps failing, instead of queueing them behind timeouts.
+
+    `failure_threshold` consecutive service errors open the circuit. New requests are then refused for
+    `reset_after_seconds`. After that one probe request is let through, and its outcome closes the circuit or opens
+    it again. A `failure_threshold` of None disables the breaker.
+    """
+
+    def __init__(self, failure_threshold=5, reset_after_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_after_seconds = reset_after_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probe_started_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def allow(self):
+        """Whether a new request may be sent now; in the half-open state only one probe at a time is allowed."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_after_seconds:
+                return False
+            # A probe that never reported back (e.g. it was cancelled) stops blocking the next one after a while
+            if self._probe_started_at is not None and now - self._probe_started_at < self.reset_after_seconds:
+                return False
+            self._probe_started_at = now
+            return True
+
+    def retry_in(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_after_seconds - (time.monotonic() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_started_at = None
+
+    def record_failure(self):
+        if self.failure_threshold is None:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._probe_started_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("Circuit breaker opened", extra={"consecutive_failures": self._failures})
+                self._opened_at = time.monotonic()
+                self._probe_started_at = None
+
+
+class RequestHandle:
+    def __init__(self, user_id, fn, args, kwargs):
+        self.user_id = user_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        """Drop the request if it is still queued, or ask it to stop at its next checkpoint if it is running."""
+        self.cancel_event.set()
+        self.future.cancel()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class BedrockRequestEngine:
+    """Runs KnowledgeBaseChat calls on a shared worker pool with a global, adaptive concurrency limit.
+
+    Queued requests are served round-robin per user so one chatty user cannot starve the others. A
+    ThrottlingException halves the concurrency limit and the request is retried after a jittered exponential backoff;
+    every `limit` consecutive successes raise the limit by one again, up to `max_concurrency`. Service errors and
+    stream timeouts are retried the same way and feed a CircuitBreaker, which refuses new requests while Bedrock keeps
+    failing.
+    """
+
+    def __init__(self, kb_chat, max_concurrency=8, max_retries=4, base_backoff_seconds=0.5, max_backoff_seconds=20,
+                 max_stream_resumes=2, circuit_failure_threshold=5, circuit_reset_seconds=30):
+        self.kb_chat = kb_chat
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_stream_resumes = max_stream_resumes
+        self.circuit = CircuitBreaker(circuit_failure_threshold, circuit_reset_seconds)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="bedrock-request")
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()
+        self._in_flight = 0
+        self._successes = 0
+
+    def submit(self, user_id, fn, *args, **kwargs):
+        """Queue `fn(*args, **kwargs)` on behalf of `user_id` and return its RequestHandle."""
+        handle = RequestHandle(user_id, fn, args, kwargs)
+        with self._lock:
+            self._queues.setdefault(user_id, deque()).append(handle)
+        self._dispatch()
+        return handle
+
+    def pending(self):
+        with self._lock:
+            return sum(len(user_queue) for user_queue in self._queues.values())
+
+    def _next_handle(self):
+        # Called with the lock held: take the oldest request of the user at the front, then move that user to the back
+        while self._queues:
+            user_id, user_queue = next(iter(self._queues.items()))
+            handle = user_queue.popleft()
+            if user_queue:
+                self._queues.move_to_end(user_id)
+            else:
+                del self._queues[user_id]
+            if handle.future.set_running_or_notify_cancel():
+                return handle
+        return None
+
+    def _dispatch(self):
+        with self._lock:
+            while self._in_flight < self.concurrency_limit:
+                handle = self._next_handle()
+                if handle is None:
+                    return
+                self._in_flight += 1
+                self._executor.submit(self._run, handle)
+
+    def _on_success(self):
+        self.circuit.record_success()
+        with self._lock:
+            self._successes += 1
+            if self._successes >= self.concurrency_limit and self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit += 1
+                self._successes = 0
+
+    def _on_throttle(self):
+        with self._lock:
+            self.concurrency_limit = max(1, self.concurrency_limit // 2)
+            self._successes = 0
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff_seconds, self.base_backoff_seconds * 2 ** attempt))
+
+    def _run(self, handle):
+        try:
+            attempt = 0
+            while True:
+                if handle.cancelled:
+                    handle.future.set_exception(RequestCancelled())
+                    return
+                if attempt == 0 and not self.circuit.allow():
+                    handle.future.set_exception(CircuitOpenError(
+                        f"Bedrock is failing; new requests are paused for {self.circuit.retry_in():.0f} s"
+                    ))
+                    return
+                try:
+                    result = handle.fn(*handle.args, **handle.kwargs)
+                except Exception as e:
+                    if is_throttling_error(e):
+                        self._on_throttle()
+                    if is_service_error(e):
+                        self.circuit.record_failure()
+                    if is_retryable_error(e) and attempt < self.max_retries and not self.circuit.is_open:
+                        # Waiting on the event lets a cancellation cut the backoff short
+                        handle.cancel_event.wait(self._backoff(attempt))
+                        attempt += 1
+                        continue
+                    handle.future.set_exception(e)
+                    return
+                self._on_success()
+                handle.future.set_result(result)
+                return
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._dispatch()
+
+    def chat_with_model(self, user_id, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, kb_chat=None,
+                        retrieval_profile=None, stateless=False):
+        """Blocking call through the engine; returns the same tuple as KnowledgeBaseChat.chat_with_model.
+
+        `kb_chat` routes the request to another pipeline with the same interface (e.g. SplitPipelineChat).
+        """
+        kb_chat = kb_chat or self.kb_chat
+        handle = self.submit(
+            user_id, kb_chat.chat_with_model, br_session_id, new_text, generation_prompt, orchestration_prompt,
+            retrieval_profile=retrieval_profile, stateless=stateless,
+        )
+        try:
+            return handle.future.result()
+        finally:
+            handle.cancel()
+
+    async def achat_with_model(self, user_id, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, kb_chat=None,
+                               retrieval_profile=None, stateless=False):
+        """Awaitable chat_with_model; cancelling the awaiting task cancels the request."""
+        kb_chat = kb_chat or self.kb_chat
+        handle = self.submit(
+            user_id, kb_chat.chat_with_model, br_session_id, new_text, generation_prompt, orchestration_prompt,
+            retrieval_profile=retrieval_profile, stateless=stateless,
+        )
+        try:
+            return await asyncio.wrap_future(handle.future)
+        except asyncio.CancelledError:
+            handle.cancel()
+            raise
+
+    def _pump_stream(self, deltas, cancel_event, kb_chat, br_session_id, new_text, generation_prompt, orchestration_prompt,
+                     result, **kwargs):
+        # Runs on a worker: consume the Bedrock stream and hand each delta to the script thread. An answer that breaks
+        # off after text was shown is asked again on the same session; when it cannot be, the text received so far
+        # stays in `result` as a partial answer. Each attempt refills `result`, so the longest partial answer of all
+        # the attempts is kept aside.
+        sent = False
+        resumes = 0
+        best_partial = {"text": "", "plain_text": "", "references": []}
+        while True:
+            try:
+                text_stream = kb_chat.chat_with_model_stream(
+                    br_session_id, new_text, generation_prompt, orchestration_prompt, result, **kwargs
+                )
+                try:
+                    for delta in text_stream:
+                        if cancel_event.is_set():
+                            return
+                        deltas.put(("text", delta))
+                        sent = True
+                finally:
+                    text_stream.close()
+                return
+            except Exception as e:
+                if not sent:
+                    raise  # nothing shown yet, so the engine retries it as a new request
+                if is_throttling_error(e):
+                    self._on_throttle()
+                if is_service_error(e):
+                    self.circuit.record_failure()
+                logger.warning("Answer stream interrupted", extra={"error": type(e).__name__, "resumes": resumes})
+                if len(result.get("text") or "") > len(best_partial["text"]):
+                    best_partial = {
+                        "text": result["text"], "plain_text": result.get("plain_text", ""), "references": result.get("references", [])
+                    }
+                if not (is_retryable_error(e) and resumes < self.max_stream_resumes and not self.circuit.is_open):
+                    result.update(best_partial, partial=True, error=f"{type(e).__name__}: {e}")
+                    raise StreamInterrupted() from e
+                if cancel_event.wait(self._backoff(resumes)):
+                    return
+                resumes += 1
+                result.pop("text", None)
+                result["resumes"] = resumes
+                br_session_id = result.get("session_id") or br_session_id
+                deltas.put(("text", RESUME_NOTICE))
+
+    def chat_with_model_stream(self, user_id, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, result=None,
+                               kb_chat=None, retrieval_profile=None, stateless=False):
+        """Streaming variant: returns a generator of text deltas like KnowledgeBaseChat.chat_with_model_stream.
+
+        The Bedrock stream is consumed on a worker so it counts against the concurrency limit. Closing the generator
+        (which Streamlit does when the user navigates away or reruns the script) cancels the request. An answer that
+        breaks off is retried on the same session up to `max_stream_resumes` times, with RESUME_NOTICE streamed in
+        between; if it still fails, the generator ends normally with `result["partial"]` set and `result["text"]`
+        holding the answer as far as it got.
+        """
+        result = result if result is not None else {}
+        deltas = queue.Queue()
+        cancel_event = threading.Event()
+        handle = self.submit(
+            user_id, self._pump_stream, deltas, cancel_event, kb_chat or self.kb_chat,
+            br_session_id, new_text, generation_prompt, orchestration_prompt, result, retrieval_profile=retrieval_profile,
+            stateless=stateless,
+        )
+        handle.future.add_done_callback(lambda future: deltas.put(("done", None)))
+
+        def iter_deltas():
+            try:
+                while True:
+                    kind, delta = deltas.get()
+                    if kind == "done":
+                        break
+                    yield delta
+                try:
+                    handle.future.result()
+                except StreamInterrupted:
+                    pass  # `result` holds the partial answer
+            finally:
+                cancel_event.set()
+                handle.cancel()
+
+        return iter_deltas()
@@ -0,0 +1,49 @@
+import re
+from client_packages.settings import AUTO_PROFILE
+
+# Questions that need many chunks, or several sub-queries, to be answered well
+broad_query_regex = re.compile(
+    r"\b(compare|comparison|compared|differences?|versus|vs\.?|contrast|pros and cons|advantages|disadvantages|"
+    r"trade-?offs?|list (all|every)|all (the )?\w+s\b|every|each|across|overview|summari[sz]e|summary|trends?|"
+    r"relationship between|impact of|how (has|have|did) .+ changed?)\b",
+    re.IGNORECASE,
+)
+# Questions after a single fact
+lookup_query_regex = re.compile(
+    r"^\s*(what|who|when|where|which)\s+(is|was|are|were)\b|^\s*(define|definition of|how (many|much)|"
+    r"what does .+ (mean|stand for))\b",
+    re.IGNORECASE,
+)
+FAST_MAX_WORDS = 12
+THOROUGH_MIN_WORDS = 30
+
+
+def classify_query(query):
+    """Pick "fast", "balanced" or "thorough" for a question from its wording alone (no model call).
+
+    Short single-fact lookups are "fast"; comparisons, enumerations, summaries, multi-part and very long questions
+    are "thorough"; everything else is "balanced".
+    """
+    n_words = len(query.split())
+    parts = query.count("?") + len(re.findall(r"\band (also|then)\b", query, re.IGNORECASE))
+    if broad_query_regex.search(query) or parts > 1 or n_words >= THOROUGH_MIN_WORDS:
+        return "thorough"
+    if n_words <= FAST_MAX_WORDS and lookup_query_regex.search(query):
+        return "fast"
+    return "balanced"
+
+
+def resolve_retrieval_profile(settings, requested, query):
+    """Return (RetrievalProfile or None, chosen automatically) for a question.
+
+    `requested` is a profile name, "auto", or None for the configured default. None means no profiles are
+    configured (or "auto" picked one that is not), so bedrock_configuration applies unchanged.
+    """
+    requested = requested or settings.default_retrieval_profile
+    if requested is None:
+        return None, False
+    if requested == AUTO_PROFILE:
+        return settings.retrieval_profiles.get(classify_query(query)), True
+    if requested not in settings.retrieval_profiles:
+        raise ValueError(f"Unknown retrieval profile {requested!r}; configured: {sorted(settings.retrieval_profiles)}")
+    return settings.retrieval_profiles[requested], False
@@ -0,0 +1,245 @@
+import os
+import time
+import threading
+import yaml
+from pathlib import Path
+from dataclasses import dataclass
+from client_packages.telemetry import logger
+
+CONFIG_PATH: Path = Path(__file__).parent.parent / "config" / "config.yaml"
+SEARCH_TYPES = ("HYBRID", "SEMANTIC")
+QUERY_SPLIT_TYPES = (None, "QUERY_DECOMPOSITION")
+AUTO_PROFILE = "auto"
+
+
+class ConfigError(ValueError):
+    """config.yaml is missing a required setting or has an invalid value."""
+
+
+@dataclass(frozen=True)
+class ModelParameters:
+    max_tokens: int
+    temperature: float
+    top_p: float
+
+
+@dataclass(frozen=True)
+class BedrockSettings:
+    """The `bedrock_configuration` section, validated."""
+
+    kb_id: str
+    inference_model_id: str
+    rerank_model_id: str
+    account_id: str
+    aws_region: str
+    search_type: str
+    n_source_chunks: int
+    n_re_ranked_docs: int
+    query_split_type: str | None
+    enable_guardrails: bool
+    guardrail_id: str | None
+    guardrail_version: str | None
+    generation: ModelParameters
+    orchestration: ModelParameters
+    generation_prompt: str
+    orchestration_prompt: str
+
+    @property
+    def generation_model_arn(self):
+        return f"arn:aws:bedrock:{self.aws_region}:{self.account_id}:inference-profile/{self.inference_model_id}"
+
+    @property
+    def rerank_model_arn(self):
+        return f"arn:aws:bedrock:{self.aws_region}::foundation-model/{self.rerank_model_id}"
+
+
+@dataclass(frozen=True)
+class RetrievalProfile:
+    """Retrieval depth for one kind of question; a `retrieval_profiles.profiles` entry over the Bedrock defaults."""
+
+    name: str
+    search_type: str
+    n_source_chunks: int
+    n_re_ranked_docs: int
+    query_split_type: str | None
+
+
+def _validate_retrieval(values, prefix, errors):
+    if values.get("search_type") not in SEARCH_TYPES:
+        errors.append(f"{prefix}.search_type must be one of {SEARCH_TYPES}, got {values.get('search_type')!r}")
+    for key in ("n_source_chunks", "n_re_ranked_docs"):
+        value = values.get(key)
+        if not isinstance(value, int) or not 1 <= value <= 100:
+            errors.append(f"{prefix}.{key} must be an integer from 1 to 100, got {value!r}")
+    if values.get("bedrock_query_split_type") not in QUERY_SPLIT_TYPES:
+        errors.append(
+            f"{prefix}.bedrock_query_split_type must be one of {QUERY_SPLIT_TYPES}, "
+            f"got {values.get('bedrock_query_split_type')!r}"
+        )
+
+
+def parse_retrieval_profiles(section, bedrock):
+    """Return ({name: RetrievalProfile}, default profile name) from the `retrieval_profiles` section.
+
+    Settings a profile leaves out come from bedrock_configuration. Without the section there are no profiles and
+    every question uses bedrock_configuration as before.
+    """
+    section = section or {}
+    defaults = {
+        "search_type": bedrock.search_type,
+        "n_source_chunks": bedrock.n_source_chunks,
+        "n_re_ranked_docs": bedrock.n_re_ranked_docs,
+        "bedrock_query_split_type": bedrock.query_split_type,
+    }
+    errors = []
+    profiles = {}
+    for name, overrides in (section.get("profiles") or {}).items():
+        values = {**defaults, **(overrides or {})}
+        _validate_retrieval(values, f"retrieval_profiles.profiles.{name}", errors)
+        profiles[name] = RetrievalProfile(
+            name, values["search_type"], values["n_source_chunks"], values["n_re_ranked_docs"], values["bedrock_query_split_type"]
+        )
+    default = section.get("default")
+    if default is not None and default != AUTO_PROFILE and default not in profiles:
+        errors.append(f"retrieval_profiles.default must be {AUTO_PROFILE!r} or a profile name, got {default!r}")
+    if errors:
+        raise ConfigError("Invalid config.yaml:\n  " + "\n  ".join(errors))
+    return profiles, default
+
+
+def _model_parameters(section, name, errors):
+    model_config = (section or {}).get("model_config", {})
+    max_tokens = model_config.get("max_tokens")
+    temperature = model_config.get("temp")
+    top_p = model_config.get("top_p")
+    if not isinstance(max_tokens, int) or max_tokens <= 0:
+        errors.append(f"{name}.model_config.max_tokens must be a positive integer, got {max_tokens!r}")
+    for key, value in (("temp", temperature), ("top_p", top_p)):
+        if not isinstance(value, (int, float)) or not 0 <= value <= 1:
+            errors.append(f"{name}.model_config.{key} must be between 0 and 1, got {value!r}")
+    return ModelParameters(max_tokens, temperature, top_p)
+
+
+def parse_bedrock_settings(cfg):
+    """Build BedrockSettings from the raw section, raising ConfigError listing every problem found."""
+    if not isinstance(cfg, dict):
+        raise ConfigError("bedrock_configuration section is missing")
+    errors = []
+    for key in ("inference_model_id", "rerank_model_id", "account_id", "aws_region"):
+        if not cfg.get(key):
+            errors.append(f"bedrock_configuration.{key} is required")
+    _validate_retrieval(cfg, "bedrock_configuration", errors)
+    if cfg.get("enable_guardrails") and not (cfg.get("guardrail_id") and cfg.get("guardrail_version")):
+        errors.append("bedrock_configuration.guardrail_id and guardrail_version are required when guardrails are enabled")
+    generation_config = cfg.get("generation_config") or {}
+    orchestration_config = cfg.get("orchestration_config") or {}
+    generation = _model_parameters(generation_config, "generation_config", errors)
+    orchestration = _model_parameters(orchestration_config, "orchestration_config", errors)
+    if "$search_results$" not in generation_config.get("prompt", ""):
+        errors.append("generation_config.prompt must contain $search_results$")
+    if errors:
+        raise ConfigError("Invalid config.yaml:\n  " + "\n  ".join(errors))
+
+    return BedrockSettings(
+        kb_id=cfg.get("kb_id", ""),
+        inference_model_id=cfg["inference_model_id"],
+        rerank_model_id=cfg["rerank_model_id"],
+        account_id=str(cfg["account_id"]),
+        aws_region=cfg["aws_region"],
+        search_type=cfg["search_type"],
+        n_source_chunks=cfg["n_source_chunks"],
+        n_re_ranked_docs=cfg["n_re_ranked_docs"],
+        query_split_type=cfg.get("bedrock_query_split_type"),
+        enable_guardrails=bool(cfg.get("enable_guardrails")),
+        guardrail_id=cfg.get("guardrail_id"),
+        guardrail_version=str(cfg["guardrail_version"]) if cfg.get("guardrail_version") is not None else None,
+        generation=generation,
+        orchestration=orchestration,
+        generation_prompt=generation_config["prompt"],
+        orchestration_prompt=orchestration_config.get("prompt", ""),
+    )
+
+
+class Settings:
+    """One parsed and validated version of config.yaml.
+
+    `bedrock` and `retrieval_profiles` are typed; every other section is read dict-style, e.g.
+    ``settings.get("preview", {})``. A Settings object never changes: a reload produces a new one.
+    """
+
+    def __init__(self, raw, mtime=None):
+        self.raw = raw
+        self.mtime = mtime
+        self.bedrock = parse_bedrock_settings(raw.get("bedrock_configuration"))
+        self.retrieval_profiles, self.default_retrieval_profile = parse_retrieval_profiles(
+            raw.get("retrieval_profiles"), self.bedrock
+        )
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+
+def load_settings(path=CONFIG_PATH):
+    mtime = os.stat(path).st_mtime
+    with open(path, "r") as file:
+        return Settings(yaml.safe_load(file), mtime)
+
+
+class SettingsWatcher:
+    """Keeps the current Settings of a config file, reloading it when the file changes.
+
+    The file's mtime is checked at most every `check_interval_seconds`, so callers can ask for the settings on every
+    request. A changed file that fails to parse or validate is logged and the previous settings stay in use.
+    """
+
+    def __init__(self, path=CONFIG_PATH, check_interval_seconds=2.0):
+        self.path = path
+        self.check_interval_seconds = check_interval_seconds
+        self._settings = load_settings(path)
+        self._failed_mtime = None
+        self._checked_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get(self):
+        if time.monotonic() - self._checked_at < self.check_interval_seconds:
+            return self._settings
+        with self._lock:
+            if time.monotonic() - self._checked_at >= self.check_interval_seconds:
+                self._checked_at = time.monotonic()
+                self._reload_if_changed()
+        return self._settings
+
+    def _reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return  # e.g. mid-replace by an editor; checked again next time
+        if mtime in (self._settings.mtime, self._failed_mtime):
+            return
+        try:
+            self._settings = load_settings(self.path)
+            logger.info("config reloaded", extra={"path": str(self.path)})
+        except (OSError, yaml.YAMLError, ConfigError) as e:
+            # Logged once per broken version of the file
+            self._failed_mtime = mtime
+            logger.error("config reload failed, keeping the previous settings", extra={"path": str(self.path), "error": str(e)})
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def get_settings():
+    """The process-wide settings from config/config.yaml, hot-reloaded when the file changes."""
+    global _watcher
+    if _watcher is None:
+        with _watcher_lock:
+            if _watcher is None:
+                _watcher = SettingsWatcher()
+    return _watcher.get()
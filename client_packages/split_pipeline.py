@@ -0,0 +1,274 @@
+import re
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from client_packages.aws_clients import get_client
+from client_packages.stream_guard import guard_events
+from client_packages.telemetry import RequestTrace
+
+OUTPUT_FORMAT_INSTRUCTIONS = (
+    "After each sentence that uses information from the search results, cite the supporting results by their number "
+    "in square brackets, for example [1] or [2][3]. Only cite numbers of the search results listed above."
+)
+citation_marker_regex = re.compile(r"\[(\d+)\]")
+word_regex = re.compile(r"[a-z0-9]+")
+follow_up_regex = re.compile(
+    r"\b(that|this|it|those|these|them|again|shorter|longer|summari[sz]e|rephrase|simplify|simpler|elaborate|"
+    r"expand|above|previous|more detail)\b",
+    re.IGNORECASE,
+)
+# Words of a follow-up that refer back or say how to redo the answer, rather than what the question is about
+FOLLOW_UP_WORDS = {
+    "that", "this", "it", "those", "these", "them", "again", "shorter", "longer", "summarize", "summarise", "rephrase",
+    "simplify", "simpler", "elaborate", "expand", "above", "previous", "more", "detail", "details", "explain", "answer",
+}
+STOPWORDS = {
+    "a", "an", "the", "and", "or", "of", "to", "in", "on", "for", "is", "are", "was", "were", "be", "it", "that",
+    "this", "what", "which", "who", "how", "do", "does", "did", "can", "could", "please", "me", "i", "you", "with",
+}
+
+
+def content_words(text):
+    return {word for word in word_regex.findall(text.lower()) if word not in STOPWORDS}
+
+
+class SessionContextCache:
+    """Retrieved chunks and recent conversation per split-pipeline session, bounded in count and age."""
+
+    def __init__(self, max_sessions=500, ttl_seconds=3600, history_turns=5):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.history_turns = history_turns
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            context = self._sessions.get(session_id)
+            if context is None:
+                return None
+            if time.time() - context["updated_at"] > self.ttl_seconds:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return context
+
+    def put(self, session_id, query, answer, chunks, previous=None):
+        messages = list(previous["messages"]) if previous else []
+        messages += [{"role": "user", "content": [{"text": query}]}, {"role": "assistant", "content": [{"text": answer}]}]
+        context = {
+            "query": query,
+            "answer": answer,
+            "chunks": chunks,
+            "messages": messages[-2 * self.history_turns:],
+            "updated_at": time.time(),
+        }
+        with self._lock:
+            self._sessions[session_id] = context
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return context
+
+
+class SplitPipelineChat:
+    """Answers with the `retrieve` API followed by a separate Converse call, instead of retrieve_and_generate.
+
+    Retrieved chunks are kept per session, so a follow-up that is about the previous turn ("summarize that again
+    shorter") is answered from the same chunks without running vector search and reranking again. Exposes the same
+    chat_with_model / chat_with_model_stream interface as KnowledgeBaseChat; session ids are local to this pipeline.
+    """
+
+    trace_name = "split_pipeline"
+
+    def __init__(self, kb_chat, context_cache=None, reuse_similarity_threshold=0.5, max_follow_up_words=12,
+                 max_follow_up_new_words=1):
+        self.kb_chat = kb_chat
+        self.context_cache = context_cache or SessionContextCache()
+        self.reuse_similarity_threshold = reuse_similarity_threshold
+        self.max_follow_up_words = max_follow_up_words
+        self.max_follow_up_new_words = max_follow_up_new_words
+        self.runtime_client = get_client("bedrock-runtime", kb_chat.aws_region, kb_chat.config.get("aws_client_configuration", {}))
+
+    def should_reuse(self, context, query):
+        """Reuse the previous turn's chunks for short follow-ups and for questions close to the previous turn.
+
+        A short question that refers back ("summarize that again shorter") is a follow-up only if it brings at most
+        `max_follow_up_new_words` content words found neither in the previous turn nor among FOLLOW_UP_WORDS. So a
+        pronoun alone does not make "what is the parental leave policy this year?" a follow-up.
+        """
+        if context is None or not context["chunks"]:
+            return False
+        query_words = content_words(query)
+        previous_words = content_words(context["query"] + " " + context["answer"])
+        if not query_words:
+            return True
+        if follow_up_regex.search(query) and len(query.split()) <= self.max_follow_up_words:
+            if len(query_words - previous_words - FOLLOW_UP_WORDS) <= self.max_follow_up_new_words:
+                return True
+        return len(query_words & previous_words) / len(query_words) >= self.reuse_similarity_threshold
+
+    def retrieve(self, query, retrieval_profile=None, trace=None, snapshot=None):
+        # The retrieve API has no query decomposition, so only the profile's search settings apply here
+        snapshot = snapshot or self.kb_chat.snapshot()
+        response = self.kb_chat.bedrock_agent_runtime_client.retrieve(
+            knowledgeBaseId=snapshot[0].bedrock.kb_id,
+            retrievalQuery={"text": query},
+            retrievalConfiguration={"vectorSearchConfiguration": self.kb_chat.build_vector_search_config(retrieval_profile, snapshot)},
+        )
+        return [
+            {"content": result["content"], "location": result["location"], "metadata": result.get("metadata", {})}
+            for result in response.get("retrievalResults", [])
+        ]
+
+    def build_converse_request(self, generation_prompt, chunks, messages, snapshot=None):
+        settings, _ = snapshot or self.kb_chat.snapshot()
+        bedrock = settings.bedrock
+        generation_prompt = generation_prompt or bedrock.generation_prompt
+        current_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
+        search_results = "\n".join(
+            f'<search_result index="{index}">\n{chunk["content"]["text"]}\n</search_result>'
+            for index, chunk in enumerate(chunks, start=1)
+        )
+        system_prompt = (
+            generation_prompt.replace("{current_time}", current_time)
+            .replace("$search_results$", search_results)
+            .replace("$output_format_instructions$", OUTPUT_FORMAT_INSTRUCTIONS)
+        )
+        kwargs = {
+            "modelId": bedrock.generation_model_arn,
+            "system": [{"text": system_prompt}],
+            "messages": messages,
+            "inferenceConfig": {
+                "maxTokens": bedrock.generation.max_tokens,
+                "temperature": bedrock.generation.temperature,
+                "topP": bedrock.generation.top_p,
+            },
+        }
+        if bedrock.enable_guardrails:
+            kwargs["guardrailConfig"] = {"guardrailIdentifier": bedrock.guardrail_id, "guardrailVersion": bedrock.guardrail_version}
+        return kwargs
+
+    @staticmethod
+    def citations_from_markers(text, chunks):
+        """Strip the model's [n] markers and turn them into the text pieces add_references expects."""
+        parts = []
+        text_pieces = []
+        position = 0
+        length = 0
+        for match in citation_marker_regex.finditer(text):
+            number = int(match.group(1))
+            parts.append(text[position:match.start()])
+            length += match.start() - position
+            position = match.end()
+            # Markers pointing outside the search results are dropped
+            if 1 <= number <= len(chunks):
+                text_pieces.append({"start": length, "end": length, "reference": [chunks[number - 1]]})
+        parts.append(text[position:])
+        return "".join(parts), text_pieces
+
+    def _start_trace(self, new_text, retrieval_profile, streaming, snapshot):
+        profile, auto = self.kb_chat.resolve_retrieval_profile(retrieval_profile, new_text, snapshot)
+        trace = RequestTrace(self.trace_name, variant=profile, streaming=streaming, retrieval_profile=profile, auto_profile=auto)
+        return trace, profile
+
+    def _result_attributes(self, trace):
+        """Entries of a streamed request's `result` that describe how the answer was prepared."""
+        return {"reused_context": trace.attributes["reused_context"]}
+
+    def _prepare(self, br_session_id, new_text, generation_prompt, retrieval_profile, trace, snapshot):
+        session_id = br_session_id or str(uuid.uuid4())
+        context = self.context_cache.get(session_id)
+        reused = self.should_reuse(context, new_text)
+        if reused:
+            chunks = context["chunks"]
+        else:
+            with trace.span("retrieve"):
+                chunks = self.retrieve(new_text, retrieval_profile, trace, snapshot)
+        trace.attributes["reused_context"] = reused
+        trace.count("chunks", len(chunks))
+        messages = (context["messages"] if context else []) + [{"role": "user", "content": [{"text": new_text}]}]
+        with trace.span("config_build"):
+            kwargs = self.build_converse_request(generation_prompt, chunks, messages, snapshot)
+        return session_id, context, chunks, kwargs
+
+    def _generate(self, kwargs, trace):
+        with trace.span("request_send"):
+            response = self.runtime_client.converse_stream(**kwargs)
+        with trace.span("stream"):
+            for event in guard_events(response["stream"], **self.kb_chat.stream_timeouts()):
+                trace.mark("time_to_first_event")
+                if "contentBlockDelta" in event:
+                    text = event["contentBlockDelta"]["delta"].get("text", "")
+                    if text:
+                        trace.mark("time_to_first_text")
+                        trace.count("output_chars", len(text))
+                        yield text
+                if "metadata" in event:
+                    usage = event["metadata"].get("usage", {})
+                    trace.count("input_tokens", usage.get("inputTokens", 0))
+                    trace.count("output_tokens", usage.get("outputTokens", 0))
+
+    def _render(self, chunks, answer, trace):
+        """Return (answer without citation markers, answer with reference links, references)."""
+        with trace.span("citation_processing"):
+            clean_text, text_pieces = self.citations_from_markers(answer, chunks)
+            output_text, references = self.kb_chat.add_references(clean_text, text_pieces, self.kb_chat.render_segment)
+        trace.count("references", len(references))
+        return clean_text, output_text, references
+
+    def _finish(self, session_id, context, chunks, new_text, answer, trace):
+        rendered = self._render(chunks, answer, trace)
+        self.context_cache.put(session_id, new_text, answer, chunks, previous=context)
+        return rendered
+
+    def chat_with_model(self, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, retrieval_profile=None,
+                        stateless=False):
+        """Same contract as KnowledgeBaseChat.chat_with_model; the orchestration prompt and `stateless` are not used by
+        this pipeline, which has no answer cache."""
+        snapshot = self.kb_chat.snapshot()
+        trace, profile = self._start_trace(new_text, retrieval_profile, False, snapshot)
+        try:
+            session_id, context, chunks, kwargs = self._prepare(br_session_id, new_text, generation_prompt, profile, trace, snapshot)
+            answer = "".join(self._generate(kwargs, trace))
+            _, output_text, references = self._finish(session_id, context, chunks, new_text, answer, trace)
+        except Exception as e:
+            trace.finish(error=type(e).__name__)
+            raise
+        trace.finish()
+        return session_id, output_text, references
+
+    def chat_with_model_stream(self, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, result=None,
+                               retrieval_profile=None, stateless=False):
+        """Same contract as KnowledgeBaseChat.chat_with_model_stream; retrieval happens before this returns."""
+        snapshot = self.kb_chat.snapshot()
+        trace, profile = self._start_trace(new_text, retrieval_profile, True, snapshot)
+        result = result if result is not None else {}
+        try:
+            session_id, context, chunks, kwargs = self._prepare(br_session_id, new_text, generation_prompt, profile, trace, snapshot)
+        except Exception as e:
+            trace.finish(error=type(e).__name__)
+            raise
+        result.update(session_id=session_id, citations=[], retrieval_profile=profile, **self._result_attributes(trace))
+        return self._stream(session_id, context, chunks, new_text, kwargs, result, trace)
+
+    def _stream(self, session_id, context, chunks, new_text, kwargs, result, trace):
+        text_parts = []
+        completed = False
+        try:
+            for text in self._generate(kwargs, trace):
+                text_parts.append(text)
+                yield text
+            result["plain_text"], result["text"], result["references"] = self._finish(
+                session_id, context, chunks, new_text, "".join(text_parts), trace
+            )
+            completed = True
+        except Exception as e:
+            # Keep the text received so far, but not in the session context: the turn did not complete
+            result["plain_text"], result["text"], result["references"] = self._render(chunks, "".join(text_parts), trace)
+            trace.attributes["error"] = type(e).__name__
+            raise
+        finally:
+            trace.finish(completed=completed)
@@ -0,0 +1,51 @@
+import queue
+import threading
+from contextlib import suppress
+
+_END = object()
+
+
+class StreamTimeout(TimeoutError):
+    """No event arrived on a Bedrock stream within the configured timeout."""
+
+
+def guard_events(events, first_event_timeout=None, inter_event_timeout=None):
+    """Iterate a Bedrock EventStream, raising StreamTimeout if the first event or the next one takes too long.
+
+    Events are read on a helper thread, so a stalled connection cannot block the caller beyond the timeout (botocore's
+    read_timeout only applies per socket read, and is usually set much higher for long answers). When the caller stops
+    early or a timeout fires, the stream is closed, which also ends the helper thread. A timeout of None disables it.
+    """
+    if first_event_timeout is None and inter_event_timeout is None:
+        yield from events
+        return
+
+    items = queue.Queue()
+
+    def read():
+        try:
+            for event in events:
+                items.put((True, event))
+            items.put((True, _END))
+        except Exception as e:
+            items.put((False, e))
+
+    reader = threading.Thread(target=read, name="bedrock-stream-reader", daemon=True)
+    reader.start()
+    timeout = first_event_timeout
+    try:
+        while True:
+            try:
+                ok, item = items.get(timeout=timeout)
+            except queue.Empty:
+                raise StreamTimeout(f"No event from Bedrock within {timeout} s") from None
+            if not ok:
+                raise item
+            if item is _END:
+                return
+            yield item
+            timeout = inter_event_timeout
+    finally:
+        if reader.is_alive() and hasattr(events, "close"):
+            with suppress(Exception):
+                events.close()
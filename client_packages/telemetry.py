@@ -0,0 +1,148 @@
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from pythonjsonlogger.json import JsonFormatter
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:  # OpenTelemetry is optional
+    otel_trace = None
+
+logger = logging.getLogger("document_chatbot.telemetry")
+_settings = {"opentelemetry": False}
+_configure_lock = threading.Lock()
+
+
+def configure_telemetry(telemetry_config=None):
+    """Attach a JSON log handler to the telemetry logger (once per process) and apply the `telemetry` config."""
+    telemetry_config = telemetry_config or {}
+    with _configure_lock:
+        if not any(isinstance(handler.formatter, JsonFormatter) for handler in logger.handlers):
+            handler = logging.StreamHandler()
+            handler.setFormatter(JsonFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+            logger.addHandler(handler)
+            logger.propagate = False
+        logger.setLevel(telemetry_config.get("log_level", "INFO"))
+        _settings["opentelemetry"] = bool(telemetry_config.get("opentelemetry")) and otel_trace is not None
+        latency_stats.resize(telemetry_config.get("window_size", 1000))
+
+
+class LatencyStats:
+    """Rolling window of recent durations per span name, for the in-process p50/p95 panel."""
+
+    def __init__(self, window_size=1000):
+        self.window_size = window_size
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=self.window_size))
+
+    def resize(self, window_size):
+        with self._lock:
+            if window_size != self.window_size:
+                self.window_size = window_size
+                self._samples = defaultdict(
+                    lambda: deque(maxlen=self.window_size),
+                    {name: deque(samples, maxlen=window_size) for name, samples in self._samples.items()},
+                )
+
+    def record(self, name, duration_ms):
+        with self._lock:
+            self._samples[name].append(duration_ms)
+
+    @staticmethod
+    def percentile(sorted_samples, fraction):
+        return sorted_samples[min(len(sorted_samples) - 1, int(fraction * len(sorted_samples)))]
+
+    def summary(self):
+        """{name: {"count", "p50_ms", "p95_ms"}} over the current window."""
+        with self._lock:
+            snapshot = {name: sorted(samples) for name, samples in self._samples.items() if samples}
+        return {
+            name: {
+                "count": len(samples),
+                "p50_ms": round(self.percentile(samples, 0.5), 1),
+                "p95_ms": round(self.percentile(samples, 0.95), 1),
+            }
+            for name, samples in sorted(snapshot.items())
+        }
+
+
+latency_stats = LatencyStats()
+
+
+class RequestTrace:
+    """Timings and counters for one request, logged as a single JSON record when it finishes.
+
+    `span(name)` times a block (repeated spans with the same name accumulate), `mark(name)` records the time since the
+    trace started the first time it is called (e.g. time to first event), and `count(name)` / `attributes` carry
+    sizes and labels. Span and mark durations also feed `latency_stats` under "<trace name>.<span name>", and under
+    "<trace name>[<variant>].<span name>" too when a `variant` (e.g. the retrieval profile) is given. When
+    OpenTelemetry is enabled and installed, the trace and its spans are exported as OTel spans as well.
+    """
+
+    def __init__(self, name, variant=None, **attributes):
+        self.name = name
+        self.variant = variant
+        self.attributes = attributes
+        self.durations_ms = {}
+        self.counts = defaultdict(int)
+        self._start = time.perf_counter()
+        self._finished = False
+        self._otel_span = None
+        if _settings["opentelemetry"]:
+            self._otel_span = otel_trace.get_tracer(__name__).start_span(name, attributes=self._otel_attributes(attributes))
+
+    @staticmethod
+    def _otel_attributes(attributes):
+        return {k: v for k, v in attributes.items() if isinstance(v, (str, bool, int, float))}
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self._start) * 1000
+
+    @contextmanager
+    def span(self, name):
+        otel_span = None
+        if self._otel_span is not None:
+            context = otel_trace.set_span_in_context(self._otel_span)
+            otel_span = otel_trace.get_tracer(__name__).start_span(name, context=context)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations_ms[name] = self.durations_ms.get(name, 0.0) + (time.perf_counter() - start) * 1000
+            if otel_span is not None:
+                otel_span.end()
+
+    def mark(self, name):
+        if name not in self.durations_ms:
+            self.durations_ms[name] = self.elapsed_ms()
+            if self._otel_span is not None:
+                self._otel_span.add_event(name)
+
+    def count(self, name, value=1):
+        self.counts[name] += value
+
+    def finish(self, **attributes):
+        """Record the total duration and emit the trace; calling it again is a no-op."""
+        if self._finished:
+            return
+        self._finished = True
+        self.attributes.update(attributes)
+        self.durations_ms["total"] = self.elapsed_ms()
+        for span_name, duration_ms in self.durations_ms.items():
+            latency_stats.record(f"{self.name}.{span_name}", duration_ms)
+            if self.variant is not None:
+                latency_stats.record(f"{self.name}[{self.variant}].{span_name}", duration_ms)
+        logger.info(
+            self.name,
+            extra={
+                "trace": self.name,
+                "durations_ms": {k: round(v, 2) for k, v in self.durations_ms.items()},
+                "counts": dict(self.counts),
+                **self.attributes,
+            },
+        )
+        if self._otel_span is not None:
+            self._otel_span.set_attributes(self._otel_attributes({**self.attributes, **self.counts}))
+            self._otel_span.end()
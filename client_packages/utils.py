@@ -1,61 +1,158 @@
 import re
 import os
-import yaml
-import boto3
 import base64
+import threading
 import streamlit as st
 from pathlib import Path
-from urllib.parse import urlparse
+from botocore.exceptions import ClientError
+from client_packages.aws_clients import get_client
+from client_packages.document_cache import DocumentCache, DocumentTooLarge, parse_s3_path
+from client_packages.settings import get_settings
+from client_packages.telemetry import logger
 
-# Open the YAML file
 script_dir: Path = Path(__file__).parent  # Go up one level
 parent_dir: Path = script_dir.parent  # Go up one level
-config_path: Path = parent_dir / "config/config.yaml"
-with open(config_path, 'r') as file:
-    config = yaml.safe_load(file)
 
+_document_caches = {}
+_document_caches_lock = threading.Lock()
 
-def show_pdf(filepath):
-    with open(filepath, "rb") as f:
-        base64_pdf = base64.b64encode(f.read()).decode("utf-8")
-    pdf_display = f'<iframe src="data:application/pdf;base64,{base64_pdf}" width="1000" height="800" type="application/pdf"></iframe>'
-    st.markdown(pdf_display, unsafe_allow_html=True)
 
+PAGE_NUMBER_METADATA_KEY = "x-amz-bedrock-kb-document-page-number"
+static_dir: Path = parent_dir / "streamlit_app" / "static"
+
+
+def get_cited_page(metadata):
+    """Page of the cited chunk, from the metadata Bedrock attaches to PDF chunks, or None if unknown."""
+    page = (metadata or {}).get(PAGE_NUMBER_METADATA_KEY)
+    try:
+        return int(float(page)) if page is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def presigned_pdf_url(s3_path):
+    bucket_name, key = parse_s3_path(s3_path)
+    s3 = get_client('s3', client_config=get_settings().get("aws_client_configuration", {}))
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": bucket_name,
+            "Key": key,
+            "ResponseContentType": "application/pdf",
+            "ResponseContentDisposition": "inline",
+        },
+        ExpiresIn=get_settings().get("pdf_viewer", {}).get("presigned_url_expiry_seconds", 900),
+    )
+
+
+def prune_static_docs(static_docs):
+    """Remove links under `static_docs` whose cache blob was evicted.
+
+    A hard link left behind would keep the evicted file's bytes on disk, outside the document cache's size limit.
+    """
+    for link_path in static_docs.iterdir():
+        try:
+            if link_path.is_symlink():
+                stale = not link_path.exists()
+            else:
+                stale = link_path.stat().st_nlink <= 1
+            if stale:
+                link_path.unlink()
+        except FileNotFoundError:
+            pass  # pruned by another session at the same time
+
+
+def static_pdf_url(filepath):
+    """Expose a cached PDF through Streamlit static file serving, which answers the viewer's byte-range requests.
+
+    The cache blob is hard-linked (no copy) under streamlit_app/static; its name is the content hash, so URLs are
+    not guessable from the document name. Links to blobs the cache has evicted since are removed first.
+    """
+    static_docs = static_dir / "docs"
+    static_docs.mkdir(parents=True, exist_ok=True)
+    prune_static_docs(static_docs)
+    link_path = static_docs / Path(filepath).name
+    if not link_path.exists():
+        try:
+            os.link(filepath, link_path)
+        except FileExistsError:
+            pass
+        except OSError:
+            link_path.symlink_to(Path(filepath).resolve())
+    return f"app/static/docs/{link_path.name}"
+
+
+def show_pdf(s3_path, target_folder, page=None):
+    """Display a cited PDF, opened at `page` when the viewer supports it.
+
+    The `pdf_viewer.mode` setting picks how the bytes reach the browser:
+    - "presigned": the browser reads straight from S3 through a presigned URL; nothing passes through the server.
+    - "static": the PDF is served from the local document cache through Streamlit static serving
+      (needs `server.enableStaticServing = true`).
+    - "inline": the legacy base64 data URI, only for files up to `max_inline_mb`; larger files use "presigned".
+    """
+    viewer_config = get_settings().get("pdf_viewer", {})
+    mode = viewer_config.get("mode", "presigned")
+    page_fragment = f"#page={page}" if page else ""
+
+    if mode in ("static", "inline"):
+        filepath = download_s3_file(s3_path, target_folder)
+        if "/" not in filepath:
+            st.write(filepath)
+            return
+        if mode == "static":
+            src = static_pdf_url(filepath) + page_fragment
+        elif os.path.getsize(filepath) <= viewer_config.get("max_inline_mb", 5) * 1024 * 1024:
+            with open(filepath, "rb") as f:
+                base64_pdf = base64.b64encode(f.read()).decode("utf-8")
+            src = f"data:application/pdf;base64,{base64_pdf}"
+        else:
+            src = presigned_pdf_url(s3_path) + page_fragment
+    else:
+        src = presigned_pdf_url(s3_path) + page_fragment
+
+    pdf_display = f'<iframe src="{src}" width="1000" height="800" type="application/pdf"></iframe>'
+    st.markdown(pdf_display, unsafe_allow_html=True)
 
-def download_s3_file(s3_path, target_folder):
-    # Parse the S3 path
-    parsed_url = urlparse(s3_path)
-    bucket_name = parsed_url.netloc
-    key = parsed_url.path.lstrip('/')
 
-    # Initialize S3 client
-    s3 = boto3.client('s3')
+def get_document_cache(target_folder):
+    """Return the process-wide DocumentCache that stores downloads under `target_folder`."""
+    target_folder = str(target_folder)
+    with _document_caches_lock:
+        if target_folder not in _document_caches:
+            cache_config = get_settings().get("document_cache", {})
+            _document_caches[target_folder] = DocumentCache(
+                Path(target_folder) / "cache",
+                get_client('s3', client_config=get_settings().get("aws_client_configuration", {})),
+                max_bytes=cache_config.get("max_size_mb", 2048) * 1024 * 1024,
+                revalidate_after_seconds=cache_config.get("revalidate_after_seconds", 300),
+            )
+        return _document_caches[target_folder]
 
-    # Extract filename from the key
-    filename = os.path.basename(key)
-    target_path = os.path.join(target_folder, filename)
 
+def download_s3_file(s3_path, target_folder):
     try:
-        # Check if the object exists
-        s3.head_object(Bucket=bucket_name, Key=key)
-        # Download the file
-        s3.download_file(bucket_name, key, target_path)
-        print(f"File downloaded to {target_path}")
+        target_path = get_document_cache(target_folder).fetch(s3_path)
+        logger.debug("File available", extra={"source": s3_path, "path": target_path})
         return target_path
-    except s3.exceptions.NoSuchKey:
-        print("file not found")
+    except FileNotFoundError:
+        logger.warning("file not found", extra={"source": s3_path})
         return "file not found"
-    except s3.exceptions.ClientError as e:
-        # Handle other errors, e.g., 404 Not Found
-        if e.response['Error']['Code'] == '404':
-            print("file not found")
-            return "file not found"
-        else:
-            print(f"An error occurred: {e}")
-            return "An error occurred look at log file"
+    except DocumentTooLarge:
+        logger.warning("file too large", extra={"source": s3_path})
+        return "file too large to open"
+    except ClientError as e:
+        logger.exception("S3 download failed", extra={"source": s3_path, "error": str(e)})
+        return "An error occurred look at log file"
 
 
 br_regex: re.Pattern = re.compile(r"(<br ?\/>|&lt;br ?/ ?&gt;)")
+url_regex: re.Pattern = re.compile(r"(https?://[^\s]+)")
+bracketed_number_regex: re.Pattern = re.compile(r"\[(\d+)\]")
+# Everything clean_html_text and replace_bracketed_numbers_with_links rewrite, as one alternation for a single pass
+answer_markup_regex: re.Pattern = re.compile(
+    r"\[(?P<number>\d+)\]|(?P<url>https?://[^\s]+)|(?P<dollar>\$)|(?P<br><br ?\/>|&lt;br ?/ ?&gt;)"
+)
 
 
 def replace_urls_with_hyperlinks(text: str) -> str:
@@ -64,8 +161,6 @@ def replace_urls_with_hyperlinks(text: str) -> str:
     :param text: The input text containing URLs.
     :return: The modified text with URLs replaced by HTML hyperlinks.
     """
-    # Regular expression pattern for matching URLs
-    url_pattern = r"(https?://[^\s]+)"
 
     # Function to replace matched URL with HTML hyperlink
     def replace_with_link(match):
@@ -74,7 +169,7 @@ def replace_urls_with_hyperlinks(text: str) -> str:
         return f'<a href="{url}" target="_blank">{url}</a>'
 
     # Use re.sub to replace URLs with hyperlinks
-    return re.sub(url_pattern, replace_with_link, text)
+    return url_regex.sub(replace_with_link, text)
 
 
 def clean_html_text(html_text) -> str:
@@ -92,7 +187,30 @@ def replace_match(match, base_url):
 
 
 def replace_bracketed_numbers_with_links(text, base_url):
-    pattern = r'\[(\d+)\]'
-    replaced_text = re.sub(pattern, lambda match: replace_match(match, base_url), text)
+    replaced_text = bracketed_number_regex.sub(lambda match: replace_match(match, base_url), text)
     replaced_text = clean_html_text(replaced_text)
     return replaced_text
+
+
+def render_answer_segment(text, base_url="#"):
+    """Single-pass equivalent of replace_bracketed_numbers_with_links: bracketed numbers and URLs become links, "$" is
+    escaped for markdown and <br/> variants are normalised, all in one sweep over the text.
+
+    :param text: A piece of model output text.
+    :param base_url: Prefix for the bracketed-number links.
+    :return: The rendered HTML/markdown text.
+    """
+
+    def replace(match):
+        kind = match.lastgroup
+        if kind == "number":
+            number = match.group("number")
+            return f'<a href="{base_url}{number}">[{number}]</a>'
+        if kind == "url":
+            url = match.group("url")
+            return f'<a href="{url}" target="_blank">{url}</a>'
+        if kind == "dollar":
+            return r"\$"
+        return "<br>"
+
+    return answer_markup_regex.sub(replace, text)
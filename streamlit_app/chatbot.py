@@ -1,47 +1,253 @@
 import uuid
-import yaml
-import json
+import itertools
 import petname
 import pandas as pd
 import streamlit as st
 from pathlib import Path
 from client_packages.bedrock_client import KnowledgeBaseChat
-from client_packages.utils import replace_bracketed_numbers_with_links, download_s3_file, show_pdf
+from client_packages.request_engine import BedrockRequestEngine, CircuitOpenError, is_terminal_error
+from client_packages.prefetch import DocumentPrefetcher
+from client_packages.history_store import ChatHistory, purge_spill_files
+from client_packages.conversation_store import build_conversation_store, bedrock_session_is_valid
+from client_packages.split_pipeline import SplitPipelineChat, SessionContextCache
+from client_packages.federated_pipeline import FederatedPipelineChat
+from client_packages.telemetry import latency_stats
+from client_packages.preview import read_csv_page, find_csv_matches, read_json_page, find_json_matches
+from client_packages.utils import render_answer_segment, download_s3_file, show_pdf, get_document_cache, get_cited_page
 
-# Open the YAML file
 script_dir: Path = Path(__file__).parent  # Go up one level
 parent_dir: Path = script_dir.parent  # Go up one level
-config_path: Path = parent_dir / "config/config.yaml"
 data_source_path = parent_dir / "data/"
-with open(config_path, 'r') as file:
-    config = yaml.safe_load(file)
+
+
+@st.cache_resource
+def get_kb_class():
+    # Built once per process and shared across sessions, so reruns don't re-read the config or rebuild AWS clients
+    return KnowledgeBaseChat(render_segment=render_answer_segment)
+
+
+@st.cache_resource
+def get_request_engine():
+    # One engine per process, so the concurrency limit applies across every user of this app node
+    kb_chat = get_kb_class()
+    return BedrockRequestEngine(kb_chat, **kb_chat.config.get("request_engine", {}))
+
+
+@st.cache_resource
+def get_prefetcher():
+    config = get_kb_class().config
+    prefetch_config = config.get("prefetch", {})
+    if not prefetch_config.get("enabled"):
+        return None
+    max_size_by_type = {ext: mb * 1024 * 1024 for ext, mb in prefetch_config.get("max_size_mb", {}).items()}
+    if config.get("pdf_viewer", {}).get("mode", "presigned") == "presigned":
+        # The browser reads PDFs straight from S3 in this mode, so a cached copy would never be used
+        max_size_by_type.pop("pdf", None)
+    return DocumentPrefetcher(
+        get_document_cache(data_source_path),
+        max_workers=prefetch_config.get("max_workers", 4),
+        top_n=prefetch_config.get("top_n", 3),
+        max_size_by_type=max_size_by_type,
+    )
+
+
+@st.cache_resource
+def get_split_pipeline():
+    split_config = get_kb_class().config.get("split_pipeline", {})
+    if not split_config.get("enabled"):
+        return None
+    return SplitPipelineChat(
+        get_kb_class(),
+        SessionContextCache(
+            max_sessions=split_config.get("max_sessions", 500),
+            ttl_seconds=split_config.get("session_ttl_seconds", 3600),
+            history_turns=split_config.get("history_turns", 5),
+        ),
+        reuse_similarity_threshold=split_config.get("reuse_similarity_threshold", 0.5),
+        max_follow_up_words=split_config.get("max_follow_up_words", 12),
+        max_follow_up_new_words=split_config.get("max_follow_up_new_words", 1),
+    )
+
+
+@st.cache_resource
+def get_federated_pipeline():
+    federated_config = get_kb_class().config.get("federated_pipeline", {})
+    if not federated_config.get("enabled") or not federated_config.get("knowledge_bases"):
+        return None
+    return FederatedPipelineChat(
+        get_kb_class(),
+        federated_config["knowledge_bases"],
+        SessionContextCache(
+            max_sessions=federated_config.get("max_sessions", 500),
+            ttl_seconds=federated_config.get("session_ttl_seconds", 3600),
+            history_turns=federated_config.get("history_turns", 5),
+        ),
+        rerank=federated_config.get("rerank", True),
+        max_workers=federated_config.get("max_workers"),
+    )
+
+
+@st.cache_resource
+def get_conversation_store():
+    return build_conversation_store(get_kb_class().config.get("conversation_store"), parent_dir)
+
+
+COMBINED_PIPELINE = "Retrieve and generate"
+SPLIT_PIPELINE = "Retrieve, then generate"
+FEDERATED_PIPELINE = "All knowledge bases"
 
 # INITs
-kb_class = KnowledgeBaseChat()
+kb_class = get_kb_class()
+request_engine = get_request_engine()
+prefetcher = get_prefetcher()
+split_pipeline = get_split_pipeline()
+federated_pipeline = get_federated_pipeline()
+# Pipelines other than the combined one, by their name in the sidebar; None when disabled in the config
+alternative_pipelines = {SPLIT_PIPELINE: split_pipeline, FEDERATED_PIPELINE: federated_pipeline}
+conversation_store = get_conversation_store()
+config = kb_class.config
 unique_id = None
 if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+    history_config = config.get("history", {})
+    history_dir = data_source_path / "history"
+    purge_spill_files(history_dir, history_config.get("spill_max_age_hours", 24) * 3600)
+    st.session_state.chat_history = ChatHistory(
+        history_dir / f"{uuid.uuid4()}.jsonl",
+        max_in_memory_messages=history_config.get("max_in_memory_messages", 40),
+    )
 if "session_id" not in st.session_state:
     st.session_state.session_id = None
 if "generation_prompt" not in st.session_state:
-    st.session_state.generation_prompt = config["bedrock_configuration"]["generation_config"]["prompt"]
+    st.session_state.generation_prompt = kb_class.settings.bedrock.generation_prompt
 if "orchestration_prompt" not in st.session_state:
-    st.session_state.orchestration_prompt = config["bedrock_configuration"]["orchestration_config"]["prompt"]
+    st.session_state.orchestration_prompt = kb_class.settings.bedrock.orchestration_prompt
+if "pipeline" not in st.session_state:
+    st.session_state.pipeline = COMBINED_PIPELINE
 if "session_name" not in st.session_state:
     st.session_state.session_name = petname.Generate(2, separator="-")
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = None
+if "retrieval_profile" not in st.session_state:
+    st.session_state.retrieval_profile = None  # the configured default
+# The sidebar widgets keyed by these are not rendered when a run ends early in st.rerun(), and Streamlit would then
+# drop their values; re-assigning them keeps the user's choice
+st.session_state.pipeline = st.session_state.pipeline
+st.session_state.retrieval_profile = st.session_state.retrieval_profile
 
-chat_container = st.container()
-input_text = st.chat_input("Ask questions about your data")
 
-if input_text:
-    # Init
-    unique_id = uuid.uuid4()
+def conversation_user():
+    return st.session_state.get("username") or "anonymous"
+
+
+def save_turn(role, text, references=None, unique_id=None, bedrock_session_id=None, rendered_text=None):
+    """Append one turn to the persistent store, creating the conversation on its first turn.
+
+    `text` is what search sees; `rendered_text` is the answer with reference links, shown when the conversation is
+    resumed.
+    """
+    if conversation_store is None:
+        return
+    if st.session_state.conversation_id is None:
+        # The name may have been taken since it was chosen (e.g. in another tab); never append to that conversation
+        session_name = st.session_state.session_name
+        conversation_id = conversation_store.create_conversation(
+            conversation_user(), session_name, pipeline=st.session_state.pipeline
+        )
+        while conversation_id is None:
+            session_name = f"{st.session_state.session_name}-{petname.Generate(1)}"
+            conversation_id = conversation_store.create_conversation(
+                conversation_user(), session_name, pipeline=st.session_state.pipeline
+            )
+        st.session_state.update(conversation_id=conversation_id, session_name=session_name)
+    conversation_store.append_turn(
+        st.session_state.conversation_id, role, text, references, unique_id,
+        bedrock_session_id=bedrock_session_id, pipeline=st.session_state.pipeline if bedrock_session_id else None,
+        rendered_text=rendered_text,
+    )
+
+
+def resume_conversation(conversation_id):
+    """Load a stored conversation into this session, keeping its Bedrock session if Bedrock still has it."""
+    conversation = conversation_store.get_conversation(conversation_id)
+    chat_history = st.session_state.chat_history
+    chat_history.clear()
+    for turn in conversation_store.load_turns(conversation_id):
+        if turn["role"] == "user":
+            chat_history.append_user(turn["text"], turn["unique_id"])
+        else:
+            chat_history.append_assistant(turn["text"], turn["references"], unique_id=turn["unique_id"])
+
+    pipeline = conversation["pipeline"] or COMBINED_PIPELINE
+    ttl_hours = config.get("conversation_store", {}).get("bedrock_session_ttl_hours", 24)
+    session_valid = bedrock_session_is_valid(conversation, ttl_hours)
+    if pipeline in alternative_pipelines and alternative_pipelines[pipeline] is None:
+        pipeline, session_valid = COMBINED_PIPELINE, False
+    st.session_state.update(
+        conversation_id=conversation_id,
+        session_name=conversation["session_name"],
+        session_id=conversation["bedrock_session_id"] if session_valid else None,
+        pipeline=pipeline,
+    )
+
+
+# Cached files are named by content hash, so the path alone identifies the data being scanned
+@st.cache_data(show_spinner="Looking for the cited rows...", max_entries=256)
+def cached_csv_matches(file_path, chunk_text, max_matches, max_seconds):
+    return find_csv_matches(file_path, chunk_text, max_matches=max_matches, max_seconds=max_seconds)
 
-    # Append new query to chat history and display it immediately
-    st.session_state.chat_history.append({"role": "user", "text": input_text, "unique_id": unique_id})
 
-# Re-render the chat history (Streamlit re-runs this script, so need this to preserve previous chat messages)
-for i, message in enumerate(st.session_state.chat_history):  # loop through the chat history
+@st.cache_data(show_spinner="Looking for the cited entries...", max_entries=256)
+def cached_json_matches(file_path, chunk_text, max_matches, max_seconds):
+    return find_json_matches(file_path, chunk_text, max_matches=max_matches, max_seconds=max_seconds)
+
+
+def show_csv_preview(file_path, chunk_text, key):
+    """Show one page of a CSV at a time; the rows matching the cited chunk are searched for only on request, since
+    that scans the file."""
+    preview_config = config.get("preview", {})
+    page_size = preview_config.get("page_size", 100)
+    matches_key = key + " matches"
+    if st.button("Find the cited rows", key=key + " find"):
+        st.session_state[matches_key] = cached_csv_matches(
+            file_path, chunk_text, preview_config.get("max_matches", 20), preview_config.get("max_match_seconds", 10)
+        )
+        if st.session_state[matches_key]:
+            # Set before the page input is created, so it opens at the first match
+            st.session_state[key + " page"] = st.session_state[matches_key][0] // page_size + 1
+    matches = st.session_state.get(matches_key, [])
+    page = st.number_input("Page", min_value=1, key=key + " page") - 1
+
+    df = read_csv_page(file_path, page, page_size)
+    if matches:
+        st.caption("Rows matching the citation: " + ", ".join(str(row) for row in matches))
+    elif matches_key in st.session_state:
+        st.caption("No rows matching the citation were found")
+    matched_rows = set(matches)
+    st.dataframe(df.style.apply(
+        lambda row: ["background-color: #fff3b0" if row.name in matched_rows else "" for _ in row], axis=1
+    ))
+
+
+def show_json_preview(file_path, chunk_text, key):
+    """Show the file one page of top-level entries at a time, and on request the entries that match the cited chunk."""
+    preview_config = config.get("preview", {})
+    page_size = preview_config.get("page_size", 100)
+    matches_key = key + " matches"
+    if st.button("Find the cited entries", key=key + " find"):
+        st.session_state[matches_key] = cached_json_matches(
+            file_path, chunk_text, preview_config.get("max_matches", 20), preview_config.get("max_match_seconds", 10)
+        )
+    if st.session_state.get(matches_key):
+        st.caption("Entries matching the citation")
+        st.json(st.session_state[matches_key])
+    elif matches_key in st.session_state:
+        st.caption("No entries matching the citation were found")
+    page = st.number_input("Page", min_value=1, key=key + " page") - 1
+    st.json(read_json_page(file_path, page, page_size), expanded=1)
+
+
+def render_message(i, message):
+    """Render one chat message; `i` is its position in the whole history and keeps widget keys unique."""
     # renders a chat line for the given role, containing everything in the with block
     with chat_container.chat_message(message["role"]):
         if message["role"] == "user":
@@ -54,72 +260,141 @@ for i, message in enumerate(st.session_state.chat_history):  # loop through the
             # Display the text with references
             st.markdown(bot_response, unsafe_allow_html=True)
 
-            if len(message["references"]) > 0:
+            references = st.session_state.chat_history.resolve_references(message)
+            if len(references) > 0:
                 st.markdown("###### 📑 Citations: ")
 
                 # Create columns for each reference
-                columns = st.columns(len(message["references"]))
+                columns = st.columns(len(references))
 
                 # Display the references in expanders within columns
-                for idx, ref in enumerate(message['references']):
+                for idx, ref in enumerate(references):
                     source_id = ref['id']
                     with columns[idx].popover(f'[{source_id}]'):
                         st.markdown(ref['text'].replace("$", "\$"), unsafe_allow_html=True)
-                        print(ref["source"])
+                        if ref["metadata"].get("knowledge_base"):
+                            st.caption(f"Knowledge base: {ref['metadata']['knowledge_base']}")
                         file_name = ref["source"].split('/')[-1]
                         if str(file_name).endswith(".pdf"):
                             if st.button(file_name, key=file_name + str(i) + str(idx)):
-                                file_path = download_s3_file(ref["source"], data_source_path)
-                                if "/" in file_path:
-                                    show_pdf(file_path)
-                                    st.button(
-                                        "close pdf",
-                                        key="close " + file_name + str(i) + str(idx),
-                                    )
-                                else:
-                                    st.write(file_path)
+                                show_pdf(ref["source"], data_source_path, page=get_cited_page(ref["metadata"]))
+                                st.button(
+                                    "close pdf",
+                                    key="close " + file_name + str(i) + str(idx),
+                                )
                         if str(file_name).endswith(".json"):
+                            open_key = "json open " + file_name + str(i) + str(idx)
                             if st.button(file_name, key="json" + file_name + str(i) + str(idx)):
+                                st.session_state[open_key] = True
+                            if st.session_state.get(open_key):
                                 file_path = download_s3_file(ref["source"], data_source_path)
                                 if "/" in file_path:
-                                    with open(file_path, "r") as f:
-                                        data = json.load(f)
-                                    st.json(data)
-                                    st.button(
-                                        "close json",
-                                        key="json close " + file_name + str(i) + str(idx),
-                                    )
+                                    show_json_preview(file_path, ref["text"], open_key)
+                                    if st.button("close json", key="json close " + file_name + str(i) + str(idx)):
+                                        st.session_state[open_key] = False
+                                        st.rerun()
                                 else:
                                     st.write(file_path)
                         if str(file_name).endswith(".csv"):
+                            open_key = "csv open " + file_name + str(i) + str(idx)
                             if st.button(file_name, key="csv" + file_name + str(i) + str(idx)):
+                                st.session_state[open_key] = True
+                            if st.session_state.get(open_key):
                                 file_path = download_s3_file(ref["source"], data_source_path)
                                 if "/" in file_path:
-                                    st.dataframe(pd.read_csv(file_path))
-                                    st.button("close csv", key="close " + file_name + str(i) + str(idx))
+                                    show_csv_preview(file_path, ref["text"], open_key)
+                                    if st.button("close csv", key="close " + file_name + str(i) + str(idx)):
+                                        st.session_state[open_key] = False
+                                        st.rerun()
                                 else:
                                     st.write(file_path)
 
+
+chat_container = st.container()
+input_text = st.chat_input("Ask questions about your data")
+
+if input_text:
+    # Init
+    unique_id = uuid.uuid4()
+
+    # Append new query to chat history and display it immediately
+    st.session_state.chat_history.append_user(input_text, unique_id)
+    save_turn("user", input_text, unique_id=unique_id)
+
+# Re-render the chat history (Streamlit re-runs this script, so need this to preserve previous chat messages).
+# Only the latest messages are rendered on every rerun; older ones (some of them read back from disk) on request.
+chat_history = st.session_state.chat_history
+eager_messages = min(config.get("history", {}).get("eager_messages", 10), len(chat_history.messages))
+recent_messages = chat_history.messages[len(chat_history.messages) - eager_messages:]
+older_count = len(chat_history) - len(recent_messages)
+if older_count > 0:
+    with chat_container:
+        show_older = st.toggle(f"Show {older_count} earlier messages", key="show_older_messages")
+    if show_older:
+        older_messages = chat_history.load_spilled() + chat_history.messages[:len(chat_history.messages) - eager_messages]
+        for i, message in enumerate(older_messages):
+            render_message(i, message)
+for offset, message in enumerate(recent_messages):
+    render_message(older_count + offset, message)
+
 # Fetch the response and update the chat history
 if input_text:
-    with st.spinner("Retrieving AI response...", show_time=True):
-        session_id, full_text, citations = kb_class.chat_with_model(
-            br_session_id=st.session_state.session_id,
-            new_text=input_text,
-            generation_prompt=st.session_state.generation_prompt,
-            orchestration_prompt=st.session_state.orchestration_prompt,
-        )
+    stream_result = {}
+    with chat_container.chat_message("assistant"):
+        try:
+            with st.spinner("Retrieving AI response...", show_time=True):
+                text_stream = request_engine.chat_with_model_stream(
+                    user_id=st.session_state.get("username") or st.session_state.session_name,
+                    br_session_id=st.session_state.session_id,
+                    new_text=input_text,
+                    generation_prompt=st.session_state.generation_prompt,
+                    orchestration_prompt=st.session_state.orchestration_prompt,
+                    result=stream_result,
+                    kb_chat=alternative_pipelines.get(st.session_state.pipeline),
+                    retrieval_profile=st.session_state.retrieval_profile,
+                )
+                # The engine only queues the request, so wait for the first text while the spinner shows
+                first_delta = next(text_stream, None)
+            # Render the answer as it is generated; the rendered text with reference links replaces it on the rerun below
+            st.write_stream(itertools.chain([first_delta] if first_delta else [], text_stream))
+        except Exception as e:
+            if not is_terminal_error(e):
+                raise
+            # Every retry failed before any text arrived: answer the saved question with the error instead
+            if isinstance(e, CircuitOpenError):
+                error_text = f"*The AI service is having problems right now, please ask again shortly. ({e})*"
+            else:
+                error_text = f"*No answer could be retrieved ({type(e).__name__}); please ask again.*"
+            stream_result = {"session_id": st.session_state.session_id, "text": error_text, "references": []}
 
-        # Store details in session
-        st.session_state.session_id = session_id
-        st.session_state.chat_history.append({"role": "assistant",
-                                              "text": replace_bracketed_numbers_with_links(full_text, "#"),
-                                              'references': citations,
-                                              "unique_id": unique_id,
-                                              "session_id": st.session_state.session_id})
+    # The answer without reference links, for the conversation store's search
+    plain_text = stream_result.get("plain_text", stream_result["text"])
+    notes = ""
+    if stream_result.get("partial"):
+        # Bedrock failed part way and retrying did not help: keep the answer as far as it got
+        notes += "\n\n*This answer was cut off by a service error; ask again for a complete answer.*"
+    if stream_result.get("failed_knowledge_bases"):
+        # The federated pipeline answered without the knowledge bases it could not search
+        notes += "\n\n*Could not search " + ", ".join(stream_result["failed_knowledge_bases"]) + "; this answer may be incomplete.*"
+    stream_result["text"] += notes
+    plain_text += notes
 
-        # Re-run the script to display the assistant's response
-        st.rerun()
+    # Warm the document cache with the sources the user is most likely to open next
+    if prefetcher is not None:
+        prefetcher.prefetch(stream_result["references"])
+
+    # Store details in session
+    st.session_state.session_id = stream_result["session_id"]
+    st.session_state.chat_history.append_assistant(
+        stream_result["text"], stream_result["references"], unique_id=unique_id, session_id=st.session_state.session_id
+    )
+    save_turn(
+        "assistant", plain_text, stream_result["references"], unique_id, bedrock_session_id=st.session_state.session_id,
+        rendered_text=stream_result["text"],
+    )
+
+    # Re-run the script to display the assistant's response
+    st.rerun()
 
 with st.sidebar:
     st.divider()
@@ -130,18 +405,77 @@ with st.sidebar:
         max_chars=50
     )
 
-    # Update session state if user changes the name
-    st.session_state.session_name = session_name
+    # Update session state if user changes the name; stored conversations are renamed with it
+    if session_name != st.session_state.session_name:
+        if conversation_store is None:
+            renamed = True
+        elif st.session_state.conversation_id is None:
+            renamed = conversation_store.find_conversation(conversation_user(), session_name) is None
+        else:
+            renamed = conversation_store.rename_conversation(st.session_state.conversation_id, session_name)
+        if renamed:
+            st.session_state.session_name = session_name
+        else:
+            st.warning(f"You already have a conversation named '{session_name}'")
+
+    pipeline_options = [COMBINED_PIPELINE] + [name for name, pipeline in alternative_pipelines.items() if pipeline is not None]
+    if len(pipeline_options) > 1:
+        st.radio(
+            "Answer pipeline",
+            pipeline_options,
+            key="pipeline",
+            # Session ids are not shared between the pipelines, so switching starts a new conversation context
+            on_change=lambda: st.session_state.update(session_id=None),
+            help="'Retrieve, then generate' reuses the chunks retrieved for the previous question when you ask a "
+                 "follow-up about it, skipping search and reranking. 'All knowledge bases' searches every configured "
+                 "knowledge base at once and answers from the best results across them",
+        )
+
+    retrieval_profiles = list(kb_class.settings.retrieval_profiles)
+    if retrieval_profiles:
+        # None keeps the configured default, which may itself be unset (bedrock_configuration's retrieval)
+        profile_options = [None, "auto"] + retrieval_profiles
+        if st.session_state.retrieval_profile not in profile_options:  # removed by a config reload
+            st.session_state.retrieval_profile = None
+        st.selectbox(
+            "Retrieval depth",
+            profile_options,
+            key="retrieval_profile",
+            format_func=lambda option: "default" if option is None else option,
+            help="How many chunks are searched and reranked, and whether the question is split into sub-queries. "
+                 "'auto' picks a profile from the wording of each question",
+        )
 
     # Export Chat
     if st.session_state.chat_history:
         # Clear chat button
         if st.button("Clear Chat"):
-            st.session_state.chat_history = []
+            st.session_state.chat_history.clear()
             st.session_state.session_id = None
             st.session_state.session_name = petname.Generate(2, separator="-")
+            st.session_state.conversation_id = None
             st.rerun()
 
+    if conversation_store is not None:
+        with st.expander("Past conversations"):
+            search_text = st.text_input("Search past questions and answers", key="conversation_search")
+            sidebar_limit = config.get("conversation_store", {}).get("sidebar_limit", 20)
+            if search_text.strip():
+                for idx, hit in enumerate(conversation_store.search(conversation_user(), search_text, limit=sidebar_limit)):
+                    snippet = hit["text"] if len(hit["text"]) <= 120 else hit["text"][:120] + "..."
+                    st.caption(f"**{hit['session_name']}** ({hit['role']}): {snippet}")
+                    st.button("Resume", key=f"resume hit {idx}", on_click=resume_conversation, args=(hit["conversation_id"],))
+            else:
+                for conversation in conversation_store.list_conversations(conversation_user(), limit=sidebar_limit):
+                    if conversation["id"] == st.session_state.conversation_id:
+                        continue
+                    st.button(
+                        conversation["session_name"],
+                        key=f"resume {conversation['id']}",
+                        on_click=resume_conversation,
+                        args=(conversation["id"],),
+                    )
+
     st.divider()
     with st.expander("Prompt options"):
         st.subheader("Generation Prompt")
@@ -170,3 +504,11 @@ with st.sidebar:
         )
         # Save session info
         st.session_state.orchestration_prompt = orchestration_prompt
+
+    if st.session_state.get("username") in config.get("telemetry", {}).get("admin_users", []):
+        with st.expander("Latency (this process)"):
+            latency_summary = latency_stats.summary()
+            if latency_summary:
+                st.dataframe(pd.DataFrame.from_dict(latency_summary, orient="index"))
+            else:
+                st.caption("No requests recorded yet")
@@ -1,20 +1,16 @@
 import os
-import yaml
+import copy
 import streamlit as st
-from pathlib import Path
 import streamlit_authenticator as stauth
+from client_packages.settings import get_settings
 
-script_dir: Path = Path(__file__).parent  # Go up one level
-parent_dir: Path = script_dir.parent  # Go up one level
-config_path: Path = parent_dir / "config/config.yaml"
 os.makedirs('data', exist_ok=True)
 
-# Open the YAML file
-with open(config_path, 'r') as file:
-    config = yaml.safe_load(file)
+# Shared, already-parsed config; the authenticator gets its own copy of the credentials because it modifies them
+config = get_settings()
 
 authenticator = stauth.Authenticate(
-    config["credentials"],
+    copy.deepcopy(config["credentials"]),
     config["cookie"]["name"],
     config["cookie"]["key"],
     config["cookie"]["expiry_days"],
@@ -0,0 +1,48 @@
+from client_packages.answer_cache import AnswerCache, InMemoryBackend
+
+
+class CountingEmbedder:
+    """Embeds a query as its letter counts, so questions using the same letters are similar."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text):
+        self.calls.append(text)
+        return [text.count(letter) for letter in "abcdefghijklmnopqrstuvwxyz"]
+
+
+def test_exact_hits_ignore_case_whitespace_and_trailing_punctuation():
+    cache = AnswerCache(InMemoryBackend())
+    assert cache.lookup("What is X?", "scope") is None
+    cache.store("What is X?", "scope", {"text": "X is Y"})
+    assert cache.lookup("  what is   x ", "scope") == {"text": "X is Y"}
+    assert cache.lookup("what is x", "other scope") is None
+    assert cache.stats() == {"hits": 1, "semantic_hits": 0, "misses": 2, "stores": 1, "embeddings": 0}
+
+
+def test_expired_entries_are_misses():
+    cache = AnswerCache(InMemoryBackend(), ttl_seconds=0)
+    cache.store("What is X?", "scope", {"text": "X is Y"})
+    assert cache.lookup("What is X?", "scope") is None
+
+
+def test_a_missed_question_is_embedded_once():
+    embedder = CountingEmbedder()
+    cache = AnswerCache(InMemoryBackend(), embedder=embedder, similarity_threshold=0.99)
+    assert cache.lookup("What is the leave policy?", "scope") is None
+    cache.store("What is the leave policy?", "scope", {"text": "16 weeks"})
+    assert embedder.calls == ["what is the leave policy"]
+
+    assert cache.lookup("the leave policy is what", "scope") == {"text": "16 weeks"}
+    assert cache.stats()["semantic_hits"] == 1
+    assert cache.stats()["embeddings"] == 2
+
+
+def test_embedding_memo_is_bounded():
+    embedder = CountingEmbedder()
+    cache = AnswerCache(InMemoryBackend(), embedder=embedder, max_memo_embeddings=2)
+    for query in ("a", "b", "c", "b", "a"):
+        cache.lookup(query, "scope")
+    # "b" was still remembered, "a" had been dropped
+    assert embedder.calls == ["a", "b", "c", "a"]
@@ -0,0 +1,23 @@
+from benchmarks.fakes import FakeBedrockAgentRuntime, synthetic_event_stream
+from client_packages.answer_cache import AnswerCache, InMemoryBackend
+from client_packages.batch import BatchRunner
+from client_packages.bedrock_client import KnowledgeBaseChat
+
+
+def test_cached_answers_are_recorded_whole():
+    kb_chat = KnowledgeBaseChat()
+    kb_chat.bedrock_agent_runtime_client = FakeBedrockAgentRuntime(
+        synthetic_event_stream(answer_chars=200), first_event_delay_ms=0, event_delay_ms=0
+    )
+    kb_chat.answer_cache = AnswerCache(InMemoryBackend())
+    runner = BatchRunner(kb_chat, concurrency=1)
+
+    first = runner.ask({"id": "1", "question": "What is X?"})
+    second = runner.ask({"id": "2", "question": "what is x"})
+    assert kb_chat.bedrock_agent_runtime_client.calls == 1
+    assert not first["cache_hit"] and second["cache_hit"]
+    assert second["status"] == "ok"
+    assert second["answer"] == first["answer"] and len(first["answer"]) == 200
+    assert second["answer_with_references"] == first["answer_with_references"]
+    assert second["output_chars"] == 200
+    assert second["time_to_first_text_ms"] is not None
@@ -0,0 +1,65 @@
+import sqlite3
+import pytest
+from client_packages.conversation_store import ConversationStore, SQLiteConversationStore
+
+RENDERED = 'Parental leave is 16 weeks <a href="#ref-1" target="_self">[1]</a>'
+
+
+@pytest.fixture
+def store(tmp_path):
+    return SQLiteConversationStore(tmp_path / "conversations.sqlite3")
+
+
+def test_interface_is_abstract():
+    with pytest.raises(TypeError):
+        ConversationStore()
+
+
+def test_names_are_unique_per_user(store):
+    conversation_id = store.create_conversation("alice", "leave")
+    assert store.create_conversation("alice", "leave") is None
+    assert store.create_conversation("bob", "leave") is not None
+    assert store.find_conversation("alice", "leave") == conversation_id
+    other_id = store.create_conversation("alice", "travel")
+    assert not store.rename_conversation(other_id, "leave")
+    assert store.rename_conversation(other_id, "trips")
+
+
+def test_search_sees_plain_text_and_resume_gets_rendered_text(store):
+    conversation_id = store.create_conversation("alice", "leave")
+    store.append_turn(conversation_id, "user", "How long is parental leave?")
+    store.append_turn(conversation_id, "assistant", "Parental leave is 16 weeks", rendered_text=RENDERED,
+                      bedrock_session_id="session-1")
+
+    for markup in ("href", "self", "target", "ref"):
+        assert store.search("alice", markup) == []
+    hits = store.search("alice", "weeks")
+    assert [(hit["role"], hit["text"]) for hit in hits] == [("assistant", "Parental leave is 16 weeks")]
+    assert store.search("bob", "weeks") == []
+
+    assert [turn["text"] for turn in store.load_turns(conversation_id)] == ["How long is parental leave?", RENDERED]
+    assert store.get_conversation(conversation_id)["bedrock_session_id"] == "session-1"
+
+
+def test_stores_without_rendered_text_are_migrated(tmp_path):
+    path = tmp_path / "old.sqlite3"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(
+            """
+            CREATE TABLE conversations (
+                id INTEGER PRIMARY KEY, user TEXT NOT NULL, session_name TEXT NOT NULL, pipeline TEXT,
+                bedrock_session_id TEXT, created_at REAL NOT NULL, updated_at REAL NOT NULL, UNIQUE (user, session_name)
+            );
+            CREATE TABLE turns (
+                id INTEGER PRIMARY KEY, conversation_id INTEGER NOT NULL, role TEXT NOT NULL, text TEXT NOT NULL,
+                references_json TEXT, unique_id TEXT, created_at REAL NOT NULL
+            );
+            INSERT INTO conversations VALUES (1, 'alice', 'leave', NULL, NULL, 0, 0);
+            """
+        )
+        conn.execute("INSERT INTO turns VALUES (1, 1, 'assistant', ?, NULL, NULL, 0)", (RENDERED,))
+
+    store = SQLiteConversationStore(path)
+    assert store.search("alice", "href") == []
+    assert [hit["text"] for hit in store.search("alice", "weeks")] == ["Parental leave is 16 weeks [1]"]
+    assert [turn["text"] for turn in store.load_turns(1)] == [RENDERED]
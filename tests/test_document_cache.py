@@ -0,0 +1,102 @@
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from benchmarks.fakes import FakeS3Client
+from client_packages.document_cache import DocumentCache, DocumentTooLarge
+
+
+@pytest.fixture
+def s3():
+    return FakeS3Client(latency_ms=0)
+
+
+def blobs(cache):
+    return sorted(path.name for path in cache.blob_dir.iterdir())
+
+
+def test_downloads_once_and_serves_from_cache(tmp_path, s3):
+    s3.put_object("bucket", "docs/a.pdf", b"a" * 100)
+    cache = DocumentCache(tmp_path, s3)
+    path = cache.fetch("s3://bucket/docs/a.pdf")
+    assert Path(path).read_bytes() == b"a" * 100
+    assert cache.fetch("s3://bucket/docs/a.pdf") == path
+    assert cache.cached_path("s3://bucket/docs/a.pdf") == path
+    assert s3.get_calls == 1
+
+
+def test_identical_objects_share_one_blob(tmp_path, s3):
+    s3.put_object("bucket", "a.pdf", b"same")
+    s3.put_object("bucket", "copy/a.pdf", b"same")
+    cache = DocumentCache(tmp_path, s3)
+    assert cache.fetch("s3://bucket/a.pdf") == cache.fetch("s3://bucket/copy/a.pdf")
+    assert len(blobs(cache)) == 1
+
+
+def test_missing_object_raises_file_not_found(tmp_path, s3):
+    with pytest.raises(FileNotFoundError):
+        DocumentCache(tmp_path, s3).fetch("s3://bucket/missing.pdf")
+
+
+def test_concurrent_fetches_share_one_download(tmp_path):
+    s3 = FakeS3Client(latency_ms=100)
+    s3.put_object("bucket", "a.pdf", b"a" * 100)
+    cache = DocumentCache(tmp_path, s3)
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        paths = list(executor.map(lambda _: cache.fetch("s3://bucket/a.pdf"), range(5)))
+    assert len(set(paths)) == 1
+    assert s3.get_calls == 1
+
+
+def test_fetch_does_not_join_a_download_with_a_stricter_size_limit(tmp_path):
+    s3 = FakeS3Client(latency_ms=100)
+    s3.put_object("bucket", "big.pdf", b"b" * 100)
+    cache = DocumentCache(tmp_path, s3)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        prefetch = executor.submit(cache.fetch, "s3://bucket/big.pdf", max_size=10)
+        time.sleep(0.02)
+        path = cache.fetch("s3://bucket/big.pdf")
+        with pytest.raises(DocumentTooLarge):
+            prefetch.result()
+    assert Path(path).read_bytes() == b"b" * 100
+    assert s3.get_calls == 2
+
+
+def test_unchanged_object_is_revalidated_without_download(tmp_path, s3):
+    s3.put_object("bucket", "a.pdf", b"a" * 100)
+    cache = DocumentCache(tmp_path, s3, revalidate_after_seconds=0)
+    path = cache.fetch("s3://bucket/a.pdf")
+    assert cache.fetch("s3://bucket/a.pdf") == path
+    assert s3.get_calls == 2
+    assert s3.bytes_sent == 100
+
+
+def test_changed_object_replaces_its_old_blob(tmp_path, s3):
+    cache = DocumentCache(tmp_path, s3, revalidate_after_seconds=0)
+    for version in (b"v1", b"v2", b"v3"):
+        s3.put_object("bucket", "a.pdf", version)
+        assert Path(cache.fetch("s3://bucket/a.pdf")).read_bytes() == version
+    assert len(blobs(cache)) == 1
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, s3):
+    for name in "abc":
+        s3.put_object("bucket", f"{name}.pdf", name.encode() * 100)
+    cache = DocumentCache(tmp_path, s3, max_bytes=250)
+    cache.fetch("s3://bucket/a.pdf")
+    time.sleep(0.01)
+    cache.fetch("s3://bucket/b.pdf")
+    time.sleep(0.01)
+    cache.fetch("s3://bucket/a.pdf")  # a is now more recent than b
+    time.sleep(0.01)
+    cache.fetch("s3://bucket/c.pdf")
+    assert cache.cached_path("s3://bucket/b.pdf") is None
+    assert cache.cached_path("s3://bucket/a.pdf") is not None
+    assert cache.cached_path("s3://bucket/c.pdf") is not None
+    assert len(blobs(cache)) == 2
+
+
+def test_index_survives_a_restart(tmp_path, s3):
+    s3.put_object("bucket", "a.pdf", b"a" * 100)
+    path = DocumentCache(tmp_path, s3).fetch("s3://bucket/a.pdf")
+    assert DocumentCache(tmp_path, s3).cached_path("s3://bucket/a.pdf") == path
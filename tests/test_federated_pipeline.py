@@ -0,0 +1,60 @@
+import pytest
+from botocore.exceptions import ClientError
+from client_packages.bedrock_client import KnowledgeBaseChat
+from client_packages.federated_pipeline import FederatedPipelineChat
+
+
+class StubRuntime:
+    """Answers `retrieve` with one chunk per knowledge base, or raises the error given for that knowledge base, and
+    `converse_stream` with a fixed answer citing the first chunk."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration):
+        if knowledgeBaseId in self.errors:
+            raise ClientError({"Error": {"Code": self.errors[knowledgeBaseId], "Message": "failed"}}, "Retrieve")
+        return {"retrievalResults": [{
+            "content": {"text": f"policy of {knowledgeBaseId}"},
+            "location": {"type": "S3", "s3Location": {"uri": f"s3://{knowledgeBaseId}/policy.pdf"}},
+            "score": 0.5,
+        }]}
+
+    def converse_stream(self, **kwargs):
+        return {"stream": [{"contentBlockDelta": {"delta": {"text": "See the policy [1]."}}}]}
+
+
+@pytest.fixture
+def pipeline_for():
+    kb_chat = KnowledgeBaseChat()
+
+    def build(errors=None):
+        kb_chat.bedrock_agent_runtime_client = StubRuntime(errors)
+        pipeline = FederatedPipelineChat(kb_chat, {"hr": "kb-hr", "finance": "kb-finance"}, rerank=False)
+        pipeline.runtime_client = kb_chat.bedrock_agent_runtime_client
+        return pipeline
+
+    return build
+
+
+def test_merges_chunks_from_every_knowledge_base(pipeline_for):
+    chunks = pipeline_for().retrieve("leave policy")
+    assert sorted(chunk["metadata"]["knowledge_base"] for chunk in chunks) == ["finance", "hr"]
+
+
+def test_throttled_knowledge_base_fails_the_request_for_a_retry(pipeline_for):
+    with pytest.raises(ClientError):
+        pipeline_for({"kb-hr": "ThrottlingException"}).retrieve("leave policy")
+
+
+def test_knowledge_base_with_a_permanent_error_is_reported(pipeline_for):
+    pipeline = pipeline_for({"kb-hr": "AccessDeniedException"})
+    result = {}
+    assert "".join(pipeline.chat_with_model_stream(None, "leave policy", result=result)) == "See the policy [1]."
+    assert result["failed_knowledge_bases"] == ["hr"]
+    assert [reference["metadata"]["knowledge_base"] for reference in result["references"]] == ["finance"]
+
+
+def test_fails_when_every_knowledge_base_fails(pipeline_for):
+    with pytest.raises(ClientError):
+        pipeline_for({"kb-hr": "AccessDeniedException", "kb-finance": "AccessDeniedException"}).retrieve("leave policy")
@@ -0,0 +1,82 @@
+import json
+import pytest
+from client_packages.preview import find_json_matches, iter_json_items, read_csv_page, read_json_page
+
+ENTRIES = [
+    {"id": 1, "name": "Ada", "tags": ["a,b", "]"]},
+    12345678901234567890,
+    -0.5e-3,
+    "brace } and bracket ]",
+    None,
+    True,
+    [],
+    {"nested": {"deep": [1, 2, {"x": "y"}]}},
+]
+
+
+@pytest.mark.parametrize("buffer_size", [1, 2, 3, 7, 16, 1 << 16])
+def test_array_items_across_buffer_boundaries(tmp_path, buffer_size):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(ENTRIES, indent=2))
+    assert list(iter_json_items(path, buffer_size=buffer_size)) == list(enumerate(ENTRIES))
+
+
+@pytest.mark.parametrize("buffer_size", [1, 5, 1 << 16])
+def test_object_items_yield_keys(tmp_path, buffer_size):
+    data = {f"key {i}": entry for i, entry in enumerate(ENTRIES)}
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(data, indent=1))
+    assert list(iter_json_items(path, buffer_size=buffer_size)) == list(data.items())
+
+
+@pytest.mark.parametrize("buffer_size", [1, 4, 1 << 16])
+def test_json_lines(tmp_path, buffer_size):
+    path = tmp_path / "data.jsonl"
+    path.write_text("\n".join(json.dumps(entry) for entry in ENTRIES) + "\n")
+    assert list(iter_json_items(path, buffer_size=buffer_size)) == list(enumerate(ENTRIES))
+
+
+def test_empty_containers(tmp_path):
+    for text in ("[]", " { } "):
+        path = tmp_path / "empty.json"
+        path.write_text(text)
+        assert list(iter_json_items(path, buffer_size=1)) == []
+
+
+def test_truncated_file_raises(tmp_path):
+    path = tmp_path / "broken.json"
+    path.write_text('[1, 2, {"a": ')
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_items(path, buffer_size=4))
+
+
+def test_read_json_page(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(list(range(250))))
+    page = read_json_page(path, 2)
+    assert list(page) == list(range(200, 250))
+    assert page[200] == 200
+
+
+def test_find_json_matches(tmp_path):
+    path = tmp_path / "people.json"
+    path.write_text(json.dumps({"p1": {"name": "Ada", "city": "London"}, "p2": {"name": "Alan", "city": "Wilmslow"}}))
+    assert find_json_matches(path, "Ada lives in London") == {"p1": {"name": "Ada", "city": "London"}}
+
+
+@pytest.mark.parametrize("chunksize", [7, 100, 50000])
+def test_read_csv_page(tmp_path, chunksize):
+    path = tmp_path / "rows.csv"
+    path.write_text("n,square\n" + "".join(f"{n},{n * n}\n" for n in range(250)))
+    page = read_csv_page(path, 1, page_size=100, chunksize=chunksize)
+    assert list(page.index) == list(range(100, 200))
+    assert list(page["square"]) == [n * n for n in range(100, 200)]
+    assert list(read_csv_page(path, 2, page_size=100, chunksize=chunksize).index) == list(range(200, 250))
+    assert read_csv_page(path, 3, page_size=100, chunksize=chunksize).empty
+
+
+def test_read_csv_page_of_header_only_file(tmp_path):
+    path = tmp_path / "empty.csv"
+    path.write_text("a,b\n")
+    page = read_csv_page(path, 0)
+    assert page.empty and list(page.columns) == ["a", "b"]
@@ -0,0 +1,182 @@
+import time
+import threading
+import pytest
+from botocore.exceptions import ClientError
+from benchmarks.fakes import FakeBedrockAgentRuntime, synthetic_event_stream
+from client_packages.bedrock_client import KnowledgeBaseChat
+from client_packages.request_engine import (
+    RESUME_NOTICE, BedrockRequestEngine, CircuitBreaker, CircuitOpenError, is_service_error, is_throttling_error,
+)
+from client_packages.stream_guard import StreamTimeout
+
+
+def client_error(code):
+    return ClientError({"Error": {"Code": code, "Message": code}}, "RetrieveAndGenerateStream")
+
+
+class FlakyStreamChat:
+    """Pipeline stand-in whose streamed answers are given as (text parts, error raised after them or None)."""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.session_ids = []
+
+    def chat_with_model_stream(self, br_session_id, new_text, generation_prompt=None, orchestration_prompt=None, result=None,
+                               **kwargs):
+        parts, error = self.answers.pop(0)
+        self.session_ids.append(br_session_id)
+        result["session_id"] = "session-1"
+
+        def stream():
+            result["text"] = ""
+            for part in parts:
+                result["text"] += part
+                yield part
+            if error is not None:
+                raise error
+            result["references"] = []
+
+        return stream()
+
+
+def test_error_classification_accepts_event_stream_codes():
+    assert is_throttling_error(client_error("ThrottlingException"))
+    assert is_throttling_error(client_error("throttlingException"))
+    assert is_service_error(client_error("serviceUnavailableException"))
+    assert is_service_error(StreamTimeout())
+    assert not is_service_error(client_error("ValidationException"))
+
+
+def test_queued_requests_are_served_round_robin_per_user():
+    engine = BedrockRequestEngine(None, max_concurrency=1)
+    release = threading.Event()
+    order = []
+
+    def work(name):
+        if name == "a1":
+            release.wait(5)
+        order.append(name)
+
+    handles = [engine.submit("alice", work, "a1")]
+    handles += [engine.submit("alice", work, name) for name in ("a2", "a3", "a4")]
+    handles += [engine.submit("bob", work, name) for name in ("b1", "b2")]
+    assert engine.pending() == 5
+    release.set()
+    for handle in handles:
+        handle.future.result(timeout=5)
+    assert order == ["a1", "a2", "b1", "a3", "b2", "a4"]
+
+
+def test_throttling_halves_the_limit_and_successes_raise_it_again():
+    engine = BedrockRequestEngine(None, max_concurrency=4, base_backoff_seconds=0)
+    calls = []
+
+    def throttled_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise client_error("ThrottlingException")
+        return "ok"
+
+    assert engine.submit("alice", throttled_once).future.result(timeout=5) == "ok"
+    assert len(calls) == 2
+    assert engine.concurrency_limit == 2
+    # `limit` consecutive successes add one to the limit
+    engine.submit("alice", lambda: None).future.result(timeout=5)
+    assert engine.concurrency_limit == 3
+
+
+def test_gives_up_after_max_retries():
+    engine = BedrockRequestEngine(None, max_retries=2, base_backoff_seconds=0, circuit_failure_threshold=None)
+    calls = []
+
+    def always_throttled():
+        calls.append(1)
+        raise client_error("ThrottlingException")
+
+    with pytest.raises(ClientError):
+        engine.submit("alice", always_throttled).future.result(timeout=5)
+    assert len(calls) == 3
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    engine = BedrockRequestEngine(None, base_backoff_seconds=0)
+    calls = []
+
+    def invalid():
+        calls.append(1)
+        raise client_error("ValidationException")
+
+    with pytest.raises(ClientError):
+        engine.submit("alice", invalid).future.result(timeout=5)
+    assert len(calls) == 1
+    assert not engine.circuit.is_open
+
+
+def test_circuit_breaker_opens_and_lets_one_probe_through():
+    circuit = CircuitBreaker(failure_threshold=2, reset_after_seconds=0.05)
+    circuit.record_failure()
+    assert circuit.allow()
+    circuit.record_failure()
+    assert circuit.is_open and not circuit.allow()
+
+    time.sleep(0.06)
+    assert circuit.allow()
+    assert not circuit.allow()  # only one probe at a time
+    circuit.record_failure()  # the probe failed: open again straight away
+    assert circuit.is_open and not circuit.allow()
+
+    time.sleep(0.06)
+    assert circuit.allow()
+    circuit.record_success()
+    assert not circuit.is_open and circuit.allow()
+
+
+def test_open_circuit_fails_new_requests_without_calling_bedrock():
+    engine = BedrockRequestEngine(None, max_retries=0, circuit_failure_threshold=2, circuit_reset_seconds=60)
+    calls = []
+
+    def unavailable():
+        calls.append(1)
+        raise client_error("ServiceUnavailableException")
+
+    for _ in range(2):
+        with pytest.raises(ClientError):
+            engine.submit("alice", unavailable).future.result(timeout=5)
+    with pytest.raises(CircuitOpenError):
+        engine.submit("bob", unavailable).future.result(timeout=5)
+    assert len(calls) == 2
+
+
+def test_interrupted_stream_is_resumed_on_the_same_session():
+    kb_chat = FlakyStreamChat([(["Hello "], StreamTimeout()), (["Hello ", "world"], None)])
+    engine = BedrockRequestEngine(kb_chat, base_backoff_seconds=0)
+    result = {}
+    deltas = list(engine.chat_with_model_stream("alice", None, "hi", result=result))
+    assert deltas == ["Hello ", RESUME_NOTICE, "Hello ", "world"]
+    assert kb_chat.session_ids == [None, "session-1"]
+    assert result["text"] == "Hello world"
+    assert result["resumes"] == 1
+    assert not result.get("partial")
+
+
+def test_stream_that_keeps_failing_keeps_the_longest_partial_answer():
+    kb_chat = FlakyStreamChat([(["Hello ", "wor"], StreamTimeout()), (["Hi"], StreamTimeout())])
+    engine = BedrockRequestEngine(kb_chat, base_backoff_seconds=0, max_stream_resumes=1)
+    result = {}
+    deltas = list(engine.chat_with_model_stream("alice", None, "hi", result=result))
+    assert deltas == ["Hello ", "wor", RESUME_NOTICE, "Hi"]
+    assert result["partial"]
+    assert result["text"] == "Hello wor"
+    assert result["error"].startswith("StreamTimeout")
+
+
+def test_chat_with_model_through_the_engine():
+    kb_chat = KnowledgeBaseChat()
+    kb_chat.bedrock_agent_runtime_client = FakeBedrockAgentRuntime(
+        synthetic_event_stream(answer_chars=200), first_event_delay_ms=0, event_delay_ms=0
+    )
+    engine = BedrockRequestEngine(kb_chat)
+    session_id, text, references = engine.chat_with_model("alice", None, "What is the travel policy?")
+    assert session_id == "bench-session-1"
+    assert text and references
+    assert "".join(engine.chat_with_model_stream("alice", session_id, "And for interns?"))